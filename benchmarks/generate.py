@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+
+"""
+Generates a synthetic smbuilder tree, for benchmarks:
+- plugins, each including a deep chain of includes and a diamond of
+  includes (two headers sharing a common base), all shared across plugins
+- packages, extending each other in chains of a given depth, each with its
+  own templated cfg files and a large filegroup
+- an smbuild file for the plugins, included by the one defining the packages
+"""
+
+import argparse
+import os
+
+
+def write(path, text):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def generate(root, plugins=200, packages=20, include_depth=10, extends_depth=3,
+             filegroup_files=100, cfg_files=5):
+    """Writes a synthetic tree under root, and returns the path of one plugin source, to touch."""
+    # the include graph: a deep chain, and a diamond
+    scripting = os.path.join(root, 'scripting')
+    for i in range(include_depth):
+        text = '// level {}\nstock int Level{}() {{ return {}; }}\n'.format(i, i, i)
+        if i + 1 < include_depth:
+            text = '#include "chain_{}"\n'.format(i + 1) + text
+        write(os.path.join(scripting, 'include', 'chain_{}.inc'.format(i)), text)
+
+    write(os.path.join(scripting, 'include', 'diamond_base.inc'), 'stock int Base() { return 0; }\n')
+    for side in ['left', 'right']:
+        write(os.path.join(scripting, 'include', 'diamond_{}.inc'.format(side)),
+              '#include "diamond_base"\nstock int {}() {{ return Base(); }}\n'.format(side.title()))
+
+    plugin_names = []
+    for i in range(plugins):
+        name = 'plugin_{}'.format(i)
+        plugin_names.append(name)
+        includes = ['include/chain_0', 'include/diamond_left', 'include/diamond_right']
+        text = ''.join('#include "{}"\n'.format(inc) for inc in includes)
+        text += 'public void OnPluginStart() {{ PrintToServer("{}"); }}\n'.format(name)
+        write(os.path.join(scripting, name + '.sp'), text)
+
+    write(os.path.join(scripting, 'smbuild'), "GlobPlugins('*.sp')\n")
+
+    # packages, in extends chains, each with its own files
+    package_lines = []
+    for j in range(packages):
+        name = 'package_{}'.format(j)
+        package_dir = os.path.join(root, 'packages', name)
+        for k in range(cfg_files):
+            write(os.path.join(package_dir, 'cfg', name, 'config_{}.cfg'.format(k)),
+                  'hostname "{{ hostname }}"\n// {{ package }} config ' + str(k) + '\n')
+        for k in range(filegroup_files):
+            write(os.path.join(package_dir, 'files', 'file_{}.txt'.format(k)),
+                  '{} file {}\n'.format(name, k) * 20)
+            write(os.path.join(package_dir, 'files', 'model_{}.mdl'.format(k)),
+                  '{} binary {}\n'.format(name, k) * 100)
+
+        members = plugin_names[j::packages]
+        lines = [
+            "Package(",
+            "    name='{}',".format(name),
+            "    plugins={},".format(members),
+            "    cfg='packages/{}/cfg',".format(name),
+            "    filegroups={{'materials/{}': ['packages/{}/files']}},".format(name, name),
+            "    args={{'hostname': '{}'}},".format(name),
+        ]
+        if j % extends_depth:
+            lines.append("    extends=['package_{}'],".format(j - 1))
+        lines.append(")\n")
+        package_lines.append('\n'.join(lines))
+
+    # only the packages of the target's own smbuild file are built
+    write(os.path.join(root, 'smbuild'), "Include('scripting')\n\n" + '\n'.join(package_lines))
+    return os.path.join(scripting, plugin_names[0] + '.sp')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates a synthetic smbuilder tree.')
+    parser.add_argument('root', help='Directory to generate the tree in')
+    parser.add_argument('--plugins', type=int, default=200)
+    parser.add_argument('--packages', type=int, default=20)
+    parser.add_argument('--include-depth', type=int, default=10)
+    parser.add_argument('--extends-depth', type=int, default=3)
+    parser.add_argument('--filegroup-files', type=int, default=100)
+    parser.add_argument('--cfg-files', type=int, default=5)
+    args = parser.parse_args()
+    generate(args.root, args.plugins, args.packages, args.include_depth, args.extends_depth,
+             args.filegroup_files, args.cfg_files)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+"""
+Times builds of a generated tree (see generate.py) through
+builder.perform_builds, compiling with fake_spcomp:
+- cold: nothing built yet
+- warm: the package directories removed, keeping the compiled plugins and
+  the persistent state (compile manifest, file cache, parsed configs,
+  compiled templates)
+- noop: everything up to date
+- touch: one plugin source edited
+
+Results are printed, and can be written as JSON with --output, then
+compared against a later run with --compare.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARK_DIR, '..', 'src', 'smbuilder'))
+
+import builder
+import generate
+
+SCENARIOS = ['cold', 'warm', 'noop', 'touch']
+
+
+def build(root, jobs):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        builder.perform_builds(root, os.path.join(BENCHMARK_DIR, 'fake_spcomp'), jobs=jobs)
+
+
+def clear_outputs(root, keep_state):
+    """
+    Removes the builds directory, or everything in it except the compiled
+    plugins and the persistent state.
+    """
+    output_dir = os.path.join(root, 'builds')
+    if not os.path.isdir(output_dir):
+        return
+    if not keep_state:
+        shutil.rmtree(output_dir)
+        return
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        if name in (builder.STATE_DIR, 'plugins'):
+            continue
+        elif os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+
+def time_scenario(scenario, root, touch_path, jobs):
+    """Prepares the tree for a scenario, then returns how long its build took."""
+    if scenario == 'cold':
+        clear_outputs(root, keep_state=False)
+    elif scenario == 'warm':
+        build(root, jobs)
+        clear_outputs(root, keep_state=True)
+    elif scenario == 'noop':
+        build(root, jobs)
+    elif scenario == 'touch':
+        build(root, jobs)
+        with open(touch_path, 'a') as f:
+            f.write('// touched {}\n'.format(time.time()))
+
+    start = time.time()
+    build(root, jobs)
+    return time.time() - start
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(params, scenarios, repeat, jobs):
+    """Returns the results of timing each scenario repeat times on a freshly generated tree."""
+    root = tempfile.mkdtemp(prefix='smbuilder-bench-')
+    try:
+        touch_path = generate.generate(root, **params)
+        results = {}
+        for scenario in scenarios:
+            runs = sorted(time_scenario(scenario, root, touch_path, jobs) for _ in range(repeat))
+            results[scenario] = {'min': runs[0], 'median': runs[len(runs) // 2], 'runs': runs}
+            print('{:>6}: {:8.3f}s min, {:8.3f}s median'.format(scenario, runs[0], runs[len(runs) // 2]))
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+def compare(results, old_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    print('Compared with {} ({}):'.format(old_path, old.get('revision')))
+    for scenario, result in sorted(results.items()):
+        if scenario in old['results']:
+            before = old['results'][scenario]['min']
+            print('{:>6}: {:8.3f}s -> {:8.3f}s ({:+.1f}%)'.format(
+                scenario, before, result['min'], (result['min'] - before) / before * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times smbuilder builds of a synthetic tree.')
+    parser.add_argument('--plugins', type=int, default=200)
+    parser.add_argument('--packages', type=int, default=20)
+    parser.add_argument('--include-depth', type=int, default=10)
+    parser.add_argument('--extends-depth', type=int, default=3)
+    parser.add_argument('--filegroup-files', type=int, default=100)
+    parser.add_argument('--cfg-files', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.05,
+        help='Seconds each fake compile takes (default: 0.05)')
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+        help='Scenario to time, may be repeated (default: all)')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--compare', help='Compare with the results in this JSON file')
+    args = parser.parse_args()
+
+    os.environ['FAKE_SPCOMP_LATENCY'] = str(args.latency)
+    params = {
+        'plugins': args.plugins,
+        'packages': args.packages,
+        'include_depth': args.include_depth,
+        'extends_depth': args.extends_depth,
+        'filegroup_files': args.filegroup_files,
+        'cfg_files': args.cfg_files,
+    }
+    results = run(params, args.scenario or SCENARIOS, args.repeat, args.jobs)
+
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        report = {
+            'revision': git_revision(),
+            'params': dict(params, latency=args.latency, jobs=args.jobs),
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
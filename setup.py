@@ -1,4 +1,10 @@
 from distutils.core import setup
+import sys
+
+# asyncio.run, used to drive the compiler, and gzip.compress(mtime=), for
+# reproducible archives
+if sys.version_info < (3, 8):
+    sys.exit('smbuilder needs python 3.8 or newer')
 
 setup(
     name='smbuilder',
@@ -7,7 +13,7 @@ setup(
     author='Sean Lewis',
     author_email='splewis@utexas.edu',
     url='https://github.com/splewis/sm-builder',
-    scripts=['scripts/smbuilder', 'scripts/smstruct', 'scripts/smversion'],
+    scripts=['scripts/smbuilder', 'scripts/smbuilderc', 'scripts/smstruct', 'scripts/smversion'],
     packages=['smbuilder'],
     package_dir={'smbuilder': 'src/smbuilder'},
     package_data={'smbuilder': ['plugins/*.sp', 'plugins/smbuild']},
@@ -0,0 +1,219 @@
+import util
+
+from concurrent import futures
+import collections
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+import zipfile
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+ARCHIVE_FORMATS = ['tar.gz', 'tar.zst', 'zip']
+
+# every entry gets the same metadata, so archives are byte-reproducible
+# (zip can't store times before 1980)
+ENTRY_MTIME = 315532800
+
+# the tar stream is cut into gzip members of this size, compressed in parallel
+GZIP_MEMBER_SIZE = 1 << 20
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+READ_SIZE = 1 << 16
+
+# bumped whenever the bytes written for the same entries change
+ARCHIVE_VERSION = 1
+
+
+class Entry:
+    """A file in an archive: its path, and either the file it comes from or its data."""
+    def __init__(self, path, src=None, data=None):
+        self.path = path.replace(os.sep, '/')
+        self.src = src
+        self.data = data
+        if data is None:
+            st = os.stat(src)
+            self.size = st.st_size
+            self.mode = 0o755 if st.st_mode & 0o111 else 0o644
+            self.stamp = util.stat_key(st)
+        else:
+            self.size = len(data)
+            self.mode = 0o644
+            self.stamp = hashlib.sha256(data).hexdigest()
+
+    def open(self):
+        if self.data is None:
+            return open(self.src, 'rb')
+        return io.BytesIO(self.data)
+
+
+def archive_key(entries, archive_format):
+    """Returns a hash of everything an archive's bytes depend on."""
+    entries = sorted(entries, key=lambda e: e.path)
+    data = json.dumps([ARCHIVE_VERSION, archive_format] + [[e.path, e.mode, e.stamp] for e in entries])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def archive_chunks(entries, archive_format, jobs=None):
+    """
+    Returns an iterator over the bytes of an archive of entries, in path order.
+    Compression uses up to jobs threads (defaulting to the number of CPUs),
+    except for zip files, which are compressed as they are written.
+    """
+    check_format(archive_format)
+    entries = sorted(entries, key=lambda e: e.path)
+    jobs = jobs or util.cpu_count()
+    if archive_format == 'tar.gz':
+        return _gzip_members(_tar_chunks(entries), jobs)
+    elif archive_format == 'tar.zst':
+        return _zstd_chunks(_tar_chunks(entries), jobs)
+    else:
+        return _zip_chunks(entries)
+
+
+def check_format(archive_format):
+    """Raises a ValueError if archives of a format can't be written."""
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError('Unknown archive format {}'.format(archive_format))
+    if archive_format == 'tar.zst' and zstandard is None:
+        raise ValueError('tar.zst archives need the zstandard module (pip install zstandard)')
+
+
+def write_archive(path, entries, archive_format, key_path=None, jobs=None):
+    """
+    Writes an archive of entries, and returns whether it was written.
+    If a key_path is given, the archive's key is recorded there, and the
+    archive isn't rewritten while the key stays the same.
+    """
+    key = archive_key(entries, archive_format)
+    if key_path and os.path.exists(path) and os.path.exists(key_path):
+        with open(key_path) as f:
+            if f.read() == key:
+                return False
+
+    written = util.write_chunks_if_changed(path, archive_chunks(entries, archive_format, jobs))
+    if key_path:
+        util.mkdir(os.path.dirname(key_path))
+        util.write_file_atomic(key_path, key.encode('utf-8'))
+    return written
+
+
+def _read_blocks(entry):
+    with entry.open() as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            yield block
+
+
+def _tar_chunks(entries):
+    """Yields a tar stream of entries, reading each file as it goes."""
+    for entry in entries:
+        info = tarfile.TarInfo(entry.path)
+        info.size = entry.size
+        info.mtime = ENTRY_MTIME
+        info.mode = entry.mode
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+
+        size = 0
+        for block in _read_blocks(entry):
+            size += len(block)
+            yield block
+        if size != entry.size:
+            raise IOError('{} changed while it was being archived'.format(entry.src))
+        yield tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+    # end of archive marker, padded to a full record as tarfile does
+    yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+    yield tarfile.NUL * (tarfile.RECORDSIZE - 2 * tarfile.BLOCKSIZE)
+
+
+def _fixed_blocks(chunks, size):
+    """Regroups chunks of bytes into blocks of exactly size bytes (except the last)."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+
+def _gzip_members(chunks, jobs):
+    """
+    Compresses chunks into a multi-member gzip stream, which any gzip reader
+    decompresses as one. Members are compressed on up to jobs threads.
+    """
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        for block in _fixed_blocks(chunks, GZIP_MEMBER_SIZE):
+            pending.append(executor.submit(gzip.compress, block, GZIP_LEVEL, mtime=0))
+            # bound how much is held in memory
+            if len(pending) > 2 * jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _zstd_chunks(chunks, jobs):
+    compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=jobs)
+    compressobj = compressor.compressobj()
+    for chunk in chunks:
+        data = compressobj.compress(chunk)
+        if data:
+            yield data
+    yield compressobj.flush()
+
+
+class _Sink:
+    """An unseekable file-like object collecting what is written to it."""
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks = self.chunks
+        self.chunks = []
+        return chunks
+
+
+def _zip_chunks(entries):
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for entry in entries:
+            info = zipfile.ZipInfo(entry.path, date_time=time.gmtime(ENTRY_MTIME)[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.create_system = 3
+            info.external_attr = (0o100000 | entry.mode) << 16
+            info.file_size = entry.size
+            with zf.open(info, 'w') as dst:
+                for block in _read_blocks(entry):
+                    dst.write(block)
+                    for chunk in sink.drain():
+                        yield chunk
+            for chunk in sink.drain():
+                yield chunk
+
+    for chunk in sink.drain():
+        yield chunk
@@ -1,14 +1,41 @@
+import archive
+import compilecache
+import compiledriver
 import includescanner
+import packagegraph
+import packagemanifest
+import profiler
 import util
 
 import fileinput
 import fnmatch
 import glob
+import hashlib
 import os
-import shutil
-import subprocess
+import threading
 
 import jinja2
+import jinja2.utils
+
+
+# how much of a file is checked for NUL bytes to decide it's binary
+BINARY_SNIFF_SIZE = 8192
+
+# compiled templates, see get_template
+TEMPLATE_CACHE_SIZE = 1000
+_template_env = jinja2.Environment()
+_templates = jinja2.utils.LRUCache(TEMPLATE_CACHE_SIZE)
+_template_lock = threading.Lock()
+
+
+class CompileError(Exception):
+    """Raised when the compiler fails on a plugin."""
+    pass
+
+
+class PackageError(Exception):
+    """Raised when a package can't be created."""
+    pass
 
 
 class PluginContainer:
@@ -25,61 +52,132 @@ class PluginContainer:
             self.source_dir = os.path.relpath(os.path.dirname(binary), '.')
 
         self.source_files = set()
-
-    def compile(self, compiler, output_dir, flags):
-        """Compiles, if needed the plugin and returns whether it was compiled."""
+        self.diagnostics = []
+
+    def compile(self, compiler, output_dir, flags, log=None, manifest=None, include_graph=None,
+                store=None):
+        """
+        Compiles, if needed (see compile_status) the plugin and returns whether it was compiled.
+        Output other than diagnostics goes to the log list, if one is given.
+        Raises a CompileError if the compiler fails.
+        """
         if self.binary:
-            shutil.copyfile(self.binary, os.path.join(output_dir, self.name + '.smx'))
+            util.sync_file(self.binary, os.path.join(output_dir, self.name + '.smx'))
             return False
 
-        latest_source_change, self.source_files = (
-            includescanner.find_last_time_modified(self.source))
+        if manifest is None:
+            manifest = compilecache.CompileManifest()
+        if include_graph is None:
+            include_graph = includescanner.IncludeGraph()
 
-        binary_file_name = os.path.join(output_dir, self.name + '.smx')
-        latest_binary_change = 0
-        if os.path.exists(binary_file_name):
-            latest_binary_change = os.path.getmtime(binary_file_name)
+        key, input_digests, compiler_id, reasons = self.compile_status(
+            compiler, output_dir, flags, manifest, include_graph)
 
-        error_filename = os.path.join(output_dir, self.name + '.txt')
-
-        def get_error_text():
-            error_text = None
-            if os.path.exists(error_filename):
-                with open(error_filename) as f:
-                    error_text = f.read().strip()
-            return error_text
+        binary_file_name = os.path.join(output_dir, self.name + '.smx')
+        if not reasons:
+            # up to date, but still show the warnings from when it was compiled
+            self.diagnostics = _recorded_diagnostics(manifest.get(self.name))
+            compiledriver.report(self.name, self.diagnostics, log)
+            return False
 
-        if latest_source_change > latest_binary_change:
-            out = os.path.join(output_dir, self.name)
-            cmd = '{} {} {} -o={} -e={}'
-            cmd = cmd.format(compiler, self.source, flags, out, error_filename)
+        def record(diagnostics):
+            self.diagnostics = diagnostics
+            manifest.update(self.name, {
+                'hash': key,
+                'inputs': input_digests,
+                'flags': flags,
+                'compiler': compiler_id,
+                'diagnostics': [d.to_dict() for d in diagnostics],
+            })
+
+        # take a matching plugin from the store instead of compiling it
+        if store:
+            warnings = store.fetch(key, binary_file_name)
+            if warnings is not None:
+                util.output('Using {} from the plugin store'.format(self.name), log)
+                diagnostics = compiledriver.parse_diagnostics(warnings)
+                compiledriver.report(self.name, diagnostics, log)
+                record(diagnostics)
+                return False
+
+        out = os.path.join(output_dir, self.name)
+        argv = compiledriver.compiler_argv(compiler, self.source, flags, out, include_graph.include_dirs)
+
+        # remove the old binary, which may be a link into the plugin store
+        # that mustn't be overwritten
+        if os.path.exists(binary_file_name):
+            os.remove(binary_file_name)
 
+        # run the actual command, it and its diagnostics are shown as they happen
+        with profiler.span('spcomp', 'compile', plugin=self.name):
             try:
-                # clear the previous error output file
-                if os.path.exists(error_filename):
-                    os.remove(error_filename)
-
-                # run the actual command
-                print(cmd)
-                subprocess.check_call(
-                    cmd, shell=True, stderr=subprocess.STDOUT)
-
-                text = get_error_text()
-                if text:
-                    util.warning(text)
-
-                return True
-
-            except subprocess.CalledProcessError:
-                msg = 'Failed to compile {}, from {}\n{}'
-                util.error(msg.format(self.name, self.smbuildfile, get_error_text()))
-
-        else:
-            text = get_error_text()
-            if text:
-                util.warning(text)
-            return False
-
+                result = compiledriver.run(argv, self.name)
+            except OSError as e:
+                manifest.remove(self.name)
+                raise CompileError('Failed to run {} for {}: {}'.format(compiler, self.name, e))
+        for line in result.output:
+            util.output(line, log)
+
+        if result.returncode != 0:
+            manifest.remove(self.name)
+            self.diagnostics = result.diagnostics
+            errors = [d.text for d in result.diagnostics if d.severity != 'warning']
+            msg = 'Failed to compile {}, from {}\n{}'
+            raise CompileError(msg.format(self.name, self.smbuildfile, '\n'.join(errors or result.output)))
+
+        record(result.diagnostics)
+        if store:
+            store.put(key, binary_file_name, result.text())
+        return True
+
+
+    def compile_status(self, compiler, output_dir, flags, manifest, include_graph):
+        """
+        Works out whether the plugin (which must have a source) needs compiling:
+        it does when the hash of its source, includes, flags and compiler
+        differs from the one recorded in the compile manifest.
+        Returns (key, input_digests, compiler_id, reasons): the compile key and
+        what went into it, and a list of reasons the plugin is out of date,
+        which is empty if it's up to date.
+        """
+        self.source_files = include_graph.relative_source_files(self.source)
+        input_digests = include_graph.input_digests(self.source)
+        compiler_id = compilecache.compiler_identity(compiler)
+        key = compilecache.compile_key(input_digests, flags, compiler_id)
+
+        reasons = []
+        entry = manifest.get(self.name)
+        if not os.path.exists(os.path.join(output_dir, self.name + '.smx')):
+            reasons.append('missing output')
+        if not entry:
+            reasons.append('no previous build')
+        elif entry['hash'] != key:
+            if entry['compiler'] != compiler_id:
+                reasons.append('compiler changed')
+            if entry['flags'] != flags:
+                reasons.append('flags changed')
+            old_inputs = entry['inputs']
+            for name in sorted(set(old_inputs) | set(input_digests)):
+                if name not in old_inputs:
+                    reasons.append('added include: {}'.format(name))
+                elif name not in input_digests:
+                    reasons.append('removed include: {}'.format(name))
+                elif old_inputs[name] != input_digests[name]:
+                    if name == os.path.basename(self.source):
+                        reasons.append('changed source: {}'.format(name))
+                    else:
+                        reasons.append('changed include: {}'.format(name))
+            if not reasons:
+                reasons.append('compile inputs changed')
+
+        return key, input_digests, compiler_id, reasons
+
+
+def _recorded_diagnostics(entry):
+    """Returns the Diagnostics of a compile manifest entry (older entries only kept their text)."""
+    if 'diagnostics' in entry:
+        return [compiledriver.Diagnostic.from_dict(d) for d in entry['diagnostics']]
+    return compiledriver.parse_diagnostics(entry.get('warnings'))
 
 
 class PackageContainer:
@@ -100,146 +198,447 @@ class PackageContainer:
         self.template_args = template_args
         self.disabled = disabled
 
-    def create(self, output_dir, packages, plugins, nosource):
-        """Creates the package output."""
-        # clears out the package, then rebuilds it
+    def create(self, output_dir, graph, plugins, nosource, link_mode='copy',
+               archive_format=None, state_dir=None):
+        """
+        Creates the package output, updating its directory in place or writing
+        an archive (see write_archive), raising a PackageError if it can't be.
+        """
+        plan = plan_package(self, output_dir, graph, plugins, nosource)
+        files = plan.files
+
+        template_files = graph.template_files(self.name)
+        templates = set(f for f in files if is_template_file(f, template_files))
+        if archive_format:
+            write_archive(self, output_dir, files, templates, graph, plugins, archive_format, state_dir)
+            return
+
         package_dir = os.path.join(output_dir, self.name)
-        if os.path.exists(package_dir):
-            shutil.rmtree(package_dir)
         util.mkdir(package_dir)
-        build_package(self, package_dir, packages, plugins, nosource)
-        replace_args(self, package_dir, packages, plugins)
-
-        # deal with any plugins supposed to be disabled
-        plugin_dir = os.path.join(package_dir, 'addons', 'sourcemod', 'plugins')
-        disabled_dir = os.path.join(package_dir, 'addons', 'sourcemod', 'plugins', 'disabled')
-        if self.disabled:
-            util.mkdir(disabled_dir)
-            for p in self.disabled:
-                src = os.path.join(plugin_dir, plugins[p].name + '.smx')
-                dst = os.path.join(disabled_dir, plugins[p].name + '.smx')
-
-                if not os.path.exists(src):
-                    msg = 'Package {} uses disables plugin {}, which it does not contain'
-                    util.error(msg.format(self.name, p))
-
-                shutil.move(src, dst)
-
-
-def build_package(package, package_dir, packages, plugins, nosource):
-    """Support function for building package files into a given directory."""
-    for p in package.extends_list:
-        try:
-            build_package(packages[p], package_dir, packages, plugins, nosource)
-        except KeyError:
-            err_msg = 'Package {} extends non-existent package {}'
-            util.error(err_msg.format(package.name, p))
-
-    cfg_dir = os.path.join(package_dir, 'cfg')
-    sm_dir = os.path.join(package_dir, 'addons', 'sourcemod')
+        build_package(self, package_dir, files, templates, link_mode)
+        replace_args(self, package_dir, files, templates, graph, plugins, link_mode)
+        util.remove_stale_files(package_dir, files)
+
+        # record what the package holds, for diffs and deploys
+        manifest_file = packagemanifest.manifest_path(output_dir, self.name)
+        previous = packagemanifest.load_previous(manifest_file)
+        manifest = packagemanifest.PackageManifest(self.name)
+        for path in files:
+            manifest.add_file(path, os.path.join(package_dir, path), previous)
+        manifest.save(manifest_file)
+
+    def plan_actions(self, output_dir, graph, plugins, nosource, recompiled=(), archive_format=None,
+                     state_dir=None):
+        """
+        Returns the actions create would take, without taking them: a list of
+        dictionaries with the action ('copy', 'render' or 'delete'), the path
+        within the package, and the reasons for it. Binaries of the plugins
+        named in recompiled are treated as changed. With an archive_format,
+        the actions are those of writing the archive, see plan_archive_actions.
+        """
+        package_dir = os.path.join(output_dir, self.name)
+        plan = plan_package(self, output_dir, graph, plugins, nosource)
+        template_files = graph.template_files(self.name)
+        recompiled = dict((os.path.join(output_dir, 'plugins', p + '.smx'), p) for p in recompiled)
+        if archive_format:
+            templates = set(f for f in plan.files if is_template_file(f, template_files))
+            return plan_archive_actions(self, output_dir, plan, templates, graph, plugins, recompiled,
+                                        archive_format, state_dir)
+
+        actions = []
+        for path in sorted(plan.files):
+            src = plan.files[path]
+            dst = os.path.join(package_dir, path)
+            action = 'copy'
+            reason = None
+            if is_template_file(path, template_files) and not is_binary_file(src):
+                try:
+                    reason = _render_reason(src, dst, graph.template_args(self.name, plugins))
+                    action = 'render'
+                except UnicodeDecodeError:
+                    pass
+
+            if action == 'copy':
+                # a recompiled binary may not exist yet
+                if src in recompiled:
+                    reason = 'plugin {} recompiled'.format(recompiled[src])
+                else:
+                    reason = util.sync_reason(src, dst)
+
+            if reason:
+                actions.append({'action': action, 'path': path, 'source': src,
+                                'from': plan.origins[path], 'reasons': [reason]})
+
+        if os.path.isdir(package_dir):
+            for path in sorted(util.stale_files(package_dir, plan.files)):
+                actions.append({'action': 'delete', 'path': path, 'reasons': ['no longer in package']})
+
+        return actions
+
+
+def _render_reason(src, dst, template_args):
+    """Returns why a rendered template's output needs rewriting, or None if it's current."""
+    if not os.path.exists(dst):
+        return 'missing output'
+
+    with open(src, 'rb') as f:
+        filedata = f.read().decode('utf-8')
+    h = hashlib.sha256()
+    for chunk in get_template(filedata).generate(**template_args):
+        h.update(chunk.encode('utf-8'))
+    if h.hexdigest() != util.file_digest(dst):
+        return 'rendered output changed'
+    return None
+
+
+class OverlayPlan:
+    """
+    The files of a package with its extends chain flattened: every output path
+    (relative to the package directory) is mapped to the single file that ends
+    up there, along with the package that provided it.
+    """
+    def __init__(self, name, layers):
+        self.name = name
+        self.layers = layers
+        self.files = {}
+        self.origins = {}
+
+    def add(self, path, src, origin):
+        path = os.path.normpath(path)
+        self.files[path] = src
+        self.origins[path] = origin
+
+    def move(self, path, new_path):
+        self.files[new_path] = self.files.pop(path)
+        self.origins[new_path] = self.origins.pop(path)
+
+    def to_dict(self):
+        """Returns the plan as a JSON-friendly dictionary, for debugging."""
+        files = {}
+        for path in sorted(self.files):
+            files[path] = {'source': self.files[path], 'from': self.origins[path]}
+        return {'package': self.name, 'layers': self.layers, 'files': files}
+
+
+def plan_package(package, output_dir, graph, plugins, nosource):
+    """
+    Returns the OverlayPlan of a package's files, resolving its whole extends
+    chain through the PackageGraph.
+    """
+    plan = OverlayPlan(package.name, graph.layers(package.name))
+    for name in plan.layers:
+        _add_package_files(plan, graph.packages[name], output_dir, plugins, nosource)
+
+    # deal with any plugins supposed to be disabled
+    plugin_dir = os.path.join('addons', 'sourcemod', 'plugins')
+    disabled_dir = os.path.join(plugin_dir, 'disabled')
+    for p in package.disabled:
+        src = os.path.join(plugin_dir, plugins[p].name + '.smx')
+        dst = os.path.join(disabled_dir, plugins[p].name + '.smx')
+
+        if src not in plan.files:
+            msg = 'Package {} uses disables plugin {}, which it does not contain'
+            raise PackageError(msg.format(package.name, p))
+
+        plan.move(src, dst)
+
+    return plan
+
+
+def _add_package_files(plan, package, output_dir, plugins, nosource):
+    """Adds the files a package itself defines (ignoring what it extends) to a plan."""
+    sm_dir = os.path.join('addons', 'sourcemod')
     plugin_dir = os.path.join(sm_dir, 'plugins')
-    config_dir = os.path.join(sm_dir, 'configs')
-    translation_dir = os.path.join(sm_dir, 'translations')
-    data_dir = os.path.join(sm_dir, 'data')
-    gamedata_dir = os.path.join(sm_dir, 'gamedata')
-    output_source_dir = os.path.join(plugin_dir, '..', 'scripting')
+    output_source_dir = os.path.join(sm_dir, 'scripting')
+
+    def add_tree(src, dst):
+        for path, src_path in _tree_files(src, dst):
+            plan.add(path, src_path, package.name)
 
     for p in package.plugins:
         if p not in plugins:
             err_msg = 'Package {} used non-existent plugin {}'
-            util.error(err_msg.format(package.name, p))
+            raise PackageError(err_msg.format(package.name, p))
 
-        # copy plugin binaries
-        util.mkdir(plugin_dir)
-        binary_path = os.path.join(package_dir, '..', 'plugins', p + '.smx')
-        shutil.copy2(binary_path, plugin_dir)
+        # plugin binaries
+        binary_path = os.path.join(output_dir, 'plugins', p + '.smx')
+        plan.add(os.path.join(plugin_dir, p + '.smx'), binary_path, package.name)
 
-        # copy source files
+        # source files
         if not nosource:
-            util.mkdir(output_source_dir)
             for source_file in plugins[p].source_files:
                 source_path = os.path.join(plugins[p].source_dir, source_file)
                 output_file_path = os.path.join(output_source_dir, source_file)
-                util.mkdir(os.path.dirname(output_file_path))
-                shutil.copyfile(source_path, output_file_path)
+                plan.add(output_file_path, source_path, package.name)
 
-    # copy filegroup definitions
+    # filegroup definitions
     for filegroup in package.filegroups:
-        filegroup_out_dir = os.path.join(package_dir, filegroup)
-        util.mkdir(filegroup_out_dir)
         for f in package.filegroups[filegroup]:
             if os.path.isdir(f):
-                util.copytree()
+                add_tree(f, filegroup)
             else:
-                shutil.copy2(f, filegroup_out_dir)
-
-    # copy everything else
-    util.safe_copytree(package.configs, config_dir)
-    util.safe_copytree(package.translations, translation_dir)
-    util.safe_copytree(package.cfg, cfg_dir)
-    util.safe_copytree(package.data, data_dir)
-    util.safe_copytree(package.gamedata, gamedata_dir)
-
-
-def replace_args(package, package_dir, packages, plugins):
-    """Performs replacement of template arguments within a directory for a package."""
-    template_args = get_template_args(package, packages, plugins)
-
-    for root, dirs, files in os.walk(package_dir):
-        for file in files:
-            path = os.path.join(root, file)
-            text_extensions = ['.cfg', '.ini', '.txt']
-            if any(map(lambda extension: extension in file, text_extensions)):
-                filedata = ''
-                with open(path, 'r') as f:
-                    filedata = f.read()
-                    templatized = ''
-                    try:
-                        templatized = templatize(filedata, template_args)
-                    except UnicodeDecodeError:
-                        templatized = filedata
-                with open(path, 'w') as f:
-                    f.write(templatized)
+                plan.add(os.path.join(filegroup, os.path.basename(f)), f, package.name)
+
+    # everything else
+    add_tree(package.configs, os.path.join(sm_dir, 'configs'))
+    add_tree(package.translations, os.path.join(sm_dir, 'translations'))
+    add_tree(package.cfg, 'cfg')
+    add_tree(package.data, os.path.join(sm_dir, 'data'))
+    add_tree(package.gamedata, os.path.join(sm_dir, 'gamedata'))
+
+
+def _tree_files(src, dst):
+    """Returns (output path, source path) pairs for every file under src, ignoring non existing paths."""
+    if not src or not os.path.isdir(src):
+        return []
+    return [(os.path.join(dst, path), os.path.join(src, path))
+            for path in util.list_files_recursively(src)]
+
+
+def is_template_file(path, template_files=None):
+    """
+    Returns whether a package file should have template arguments replaced.
+    If the package declares template_files, only files whose path within the
+    package (or, for patterns without a directory, whose name) matches one of
+    those globs are templates. Otherwise, any .cfg, .ini or .txt file is.
+    """
+    if template_files:
+        for pattern in template_files:
+            if fnmatch.fnmatch(path, pattern):
+                return True
+            if '/' not in pattern and fnmatch.fnmatch(os.path.basename(path), pattern):
+                return True
+        return False
+
+    text_extensions = ['.cfg', '.ini', '.txt']
+    return os.path.splitext(path)[1].lower() in text_extensions
+
+
+def is_binary_file(path):
+    """Returns whether a file looks like binary data, judging by its first block."""
+    with open(path, 'rb') as f:
+        return b'\0' in f.read(BINARY_SNIFF_SIZE)
+
+
+def build_package(package, package_dir, files, templates, link_mode='copy'):
+    """Support function for placing package files that changed into a given directory."""
+    with profiler.span('build_package', 'package', package=package.name, files=0, bytes=0) as span:
+        for path, src in files.items():
+            if path not in templates:
+                if util.sync_file(src, os.path.join(package_dir, path), link_mode):
+                    span.args['files'] += 1
+                    span.args['bytes'] += os.path.getsize(src)
+
+
+def replace_args(package, package_dir, files, templates, graph, plugins, link_mode='copy'):
+    """
+    Performs replacement of template arguments for the template files of a package,
+    writing only the output files whose content changed.
+    """
+    template_args = graph.template_args(package.name, plugins)
+
+    with profiler.span('replace_args', 'package', package=package.name, files=0, bytes=0) as span:
+        def encode(chunks):
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                span.args['bytes'] += len(data)
+                yield data
+
+        for path in templates:
+            src = files[path]
+            dst = os.path.join(package_dir, path)
+            span.args['files'] += 1
+            if is_binary_file(src):
+                util.sync_file(src, dst, link_mode)
+                continue
+
+            try:
+                with open(src, 'rb') as f:
+                    filedata = f.read().decode('utf-8')
+            except UnicodeDecodeError:
+                # not actually a text file
+                util.sync_file(src, dst, link_mode)
+                continue
+
+            # render in chunks, so large outputs are never held in memory whole
+            chunks = get_template(filedata).generate(**template_args)
+            util.write_chunks_if_changed(dst, encode(chunks))
+
+
+def archive_entries(package, files, templates, graph, plugins):
+    """Returns the archive.Entry of each package file, with templates rendered in memory."""
+    template_args = graph.template_args(package.name, plugins)
+    entries = []
+    for path, src in files.items():
+        data = None
+        if path in templates and not is_binary_file(src):
+            try:
+                with open(src, 'rb') as f:
+                    filedata = f.read().decode('utf-8')
+                data = get_template(filedata).render(**template_args).encode('utf-8')
+            except UnicodeDecodeError:
+                # not actually a text file
+                pass
+        entries.append(archive.Entry(path, src, data))
+    return entries
+
+
+def archive_key_path(state_dir, package_name, archive_format):
+    """Returns where the key of a package's archive is recorded, see archive.write_archive."""
+    return os.path.join(state_dir, 'archives', '{}.{}.key'.format(package_name, archive_format))
+
+
+def plan_archive_actions(package, output_dir, plan, templates, graph, plugins, recompiled,
+                         archive_format, state_dir=None):
+    """
+    Returns the actions writing a package's archive would take, as plan_actions
+    does: nothing if the archive's key is unchanged (as in write_archive),
+    otherwise an 'archive' action for each file that differs from the
+    package's manifest, and a 'delete' action for each file it no longer has.
+    """
+    filename = os.path.join(output_dir, '{}.{}'.format(package.name, archive_format))
+    manifest = packagemanifest.load_previous(packagemanifest.manifest_path(output_dir, package.name))
+    if not os.path.exists(filename) or not manifest or manifest.archive_format != archive_format:
+        manifest = None
+
+    # binaries about to be recompiled may not exist yet
+    files = dict((path, src) for path, src in plan.files.items() if src not in recompiled)
+    entries = archive_entries(package, files, templates, graph, plugins)
+    if manifest and state_dir and len(files) == len(plan.files):
+        key_path = archive_key_path(state_dir, package.name, archive_format)
+        if os.path.exists(key_path):
+            with open(key_path) as f:
+                if f.read() == archive.archive_key(entries, archive_format):
+                    return []
+
+    reasons = {}
+    for path, src in plan.files.items():
+        if src in recompiled:
+            reasons[path.replace(os.sep, '/')] = 'plugin {} recompiled'.format(recompiled[src])
+    for entry in entries:
+        reason = _archive_reason(entry, manifest)
+        if reason:
+            reasons[entry.path] = reason
+
+    actions = []
+    origins = dict((path.replace(os.sep, '/'), path) for path in plan.files)
+    for path in sorted(reasons):
+        actions.append({'action': 'archive', 'path': path, 'source': plan.files[origins[path]],
+                        'from': plan.origins[origins[path]], 'reasons': [reasons[path]]})
+    if manifest:
+        for path in sorted(set(manifest.files) - set(origins)):
+            actions.append({'action': 'delete', 'path': path, 'reasons': ['no longer in package']})
+    return actions
+
+
+def _archive_reason(entry, manifest):
+    """Returns why an archive entry differs from the package's manifest, or None if it doesn't."""
+    if manifest is None:
+        return 'missing output'
+    old = manifest.files.get(entry.path)
+    if old is None:
+        return 'new file'
+    if entry.data is not None:
+        digest = hashlib.sha256(entry.data).hexdigest()
+    elif manifest.stats.get(entry.path) == entry.stamp:
+        return None
+    else:
+        digest = util.file_digest(entry.src)
+    if digest != old['sha256']:
+        return 'source changed'
+    return None
+
+
+def write_archive(package, output_dir, files, templates, graph, plugins, archive_format, state_dir=None):
+    """
+    Writes a package into an archive next to where its directory would be
+    (e.g. builds/<name>.tar.gz), without creating that directory. Templates
+    are rendered in memory. If a state_dir is given, the archive is left
+    alone while none of its files changed.
+    """
+    entries = archive_entries(package, files, templates, graph, plugins)
+    filename = '{}.{}'.format(package.name, archive_format)
+    key_path = None
+    if state_dir:
+        key_path = archive_key_path(state_dir, package.name, archive_format)
+    with profiler.span('write_archive', 'package', package=package.name, files=len(entries)):
+        archive.write_archive(os.path.join(output_dir, filename), entries, archive_format, key_path)
+
+    manifest_file = packagemanifest.manifest_path(output_dir, package.name)
+    previous = packagemanifest.load_previous(manifest_file)
+    manifest = packagemanifest.PackageManifest(package.name, archive_format=archive_format)
+    for entry in entries:
+        if entry.data is None:
+            manifest.add_file(entry.path, entry.src, previous)
+        else:
+            manifest.add_data(entry.path, entry.data)
+    manifest.save(manifest_file)
 
 
 def templatize(text, args):
     """Replaces template arguments in a string of text."""
-    template = jinja2.Template(text)
+    template = get_template(text)
     return template.render(**args)
 
 
-def get_template_args(package, packages, plugins):
-    """Returns a dictionary of all arguments a package contains."""
-    args = {}
-    # get inherited values
-    for base_name in package.extends_list:
-        base = packages[base_name]
-        args.update(get_template_args(base, packages, plugins))
-
-    # get values from this package, overwriting old ones
-    for arg in package.template_args:
-        args[arg] = package.template_args[arg]
+def get_template(text):
+    """
+    Returns the compiled template for a string of text.
+    Templates are shared by every package and cached by a hash of their
+    content, so a file that many packages inherit is only compiled once.
+    """
+    key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    template = _templates.get(key)
+    if template is None:
+        with _template_lock:
+            template = _templates.get(key)
+            if template is None:
+                template = _compile_template(text, key)
+                _templates[key] = template
+    return template
+
+
+def set_template_cache_dir(path):
+    """Stores compiled template bytecode under a directory, or stops doing so if path is None."""
+    if path:
+        util.mkdir(path)
+        _template_env.bytecode_cache = jinja2.FileSystemBytecodeCache(path)
+    else:
+        _template_env.bytecode_cache = None
+
+
+def _compile_template(text, key):
+    # this is what jinja2's loaders do, with the content hash as the template name
+    env = _template_env
+    bucket = None
+    code = None
+    if env.bytecode_cache:
+        bucket = env.bytecode_cache.get_bucket(env, key, None, text)
+        code = bucket.code
+
+    if code is None:
+        code = env.compile(text, key)
+        if bucket:
+            bucket.code = code
+            env.bytecode_cache.set_bucket(bucket)
+
+    return env.template_class.from_code(env, code, env.make_globals(None))
 
-    # create extra plugin_binaries argument
-    plugin_binaries = []
-    deps = find_plugin_deps(package, packages)
-    for dep in deps:
-        plugin_binaries.append(plugins[dep].name + '.smx')
-    args['plugin_binaries'] = plugin_binaries
-    args['package'] = package.name
 
-    return args
+def get_template_args(package, packages, plugins):
+    """
+    Returns a dictionary of all arguments a package contains.
+    Builds should use the memoized PackageGraph.template_args instead.
+    """
+    return packagegraph.PackageGraph(packages).template_args(package.name, plugins)
 
 
 def find_plugin_deps(package, packages_dict):
-    """Returns a set of plugin names that a package includes."""
-    plugins = set()
-    for p in package.plugins:
-        plugins.add(p)
-    for p in package.extends_list:
-        if p not in packages_dict:
-            err_msg = 'Package {} extends non-existent package {}'
-            util.error(err_msg.format(package.name, p))
-
-        plugins.update(find_plugin_deps(packages_dict[p], packages_dict))
-    return plugins
+    """
+    Returns a set of plugin names that a package includes.
+    Builds should use the memoized PackageGraph.plugin_deps instead.
+    """
+    try:
+        return set(packagegraph.PackageGraph(packages_dict).plugin_deps(package.name))
+    except ValueError as e:
+        util.error(str(e))
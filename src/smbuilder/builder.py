@@ -1,34 +1,236 @@
+import archive
 import base
+import buildhistory
+import compilecache
+import filecache
+import includescanner
+import packagegraph
+import packagemanifest
 import parser
+import profiler
 import util
 
+from concurrent import futures
+import contextlib
 import os
+import time
 
 
-def perform_builds(target='.', compiler='spcomp', flags='', nosource=False):
-    """Main library entrance to build packages."""
-    plugins, packages = parser.parse_configs(target)
-    output_dir = os.path.join(target, 'builds')
-    smbuildfile = os.path.join(target, parser.CONFIG_NAME)
-    build(smbuildfile, compiler, plugins, packages, flags=flags, output_dir=output_dir, nosource=nosource)
+# where persistent build state lives, under the output directory
+STATE_DIR = '.smbuilder'
 
 
-def build(smbuildfile, compiler, plugins, packages, flags='', output_dir='builds', nosource=False):
-    """Performs the entire build process."""
+def perform_builds(target='.', compiler='spcomp', flags='', nosource=False,
+                   jobs=None, keep_going=False, include_dirs=None, immutable_stock_includes=False,
+                   store=None, link_mode='copy', template_cache=True, plan=False, warm=None,
+                   archive_format=None, profile=None):
+    """
+    Main library entrance to build packages.
+    The target may also be a workspace file or a list of targets, see
+    resolve_targets: their configs are parsed together, and every plugin is
+    compiled once into the shared output directory.
+    If plan is set, nothing is built, and the plan_build result is returned.
+    The parsed configs are cached under the output directory, see parser.parse_configs.
+    If warm is given (a buildserver.WarmState), parsed configs and caches
+    are reused from it, instead of being loaded again.
+    If a profile path is given, the time each phase took is written there,
+    see profiler.finish.
+    """
+    if profile:
+        profiler.enable()
+    try:
+        return _perform_builds(target, compiler, flags, nosource, jobs, keep_going, include_dirs,
+                               immutable_stock_includes, store, link_mode, template_cache, plan, warm,
+                               archive_format)
+    finally:
+        if profile:
+            profiler.finish(profile)
+
+
+def _perform_builds(target, compiler, flags, nosource, jobs, keep_going, include_dirs,
+                    immutable_stock_includes, store, link_mode, template_cache, plan, warm,
+                    archive_format):
+    targets, output_dir = resolve_targets(target)
+    if warm:
+        plugins, packages = warm.parse_configs(targets)
+    else:
+        registry_path = os.path.join(output_dir, STATE_DIR, parser.REGISTRY_NAME)
+        plugins, packages = parser.parse_configs(targets, registry_path)
+    smbuildfiles = [os.path.join(t, parser.CONFIG_NAME) for t in targets]
+    if plan:
+        return plan_build(smbuildfiles, compiler, plugins, packages, flags=flags, output_dir=output_dir,
+                          nosource=nosource, include_dirs=include_dirs,
+                          immutable_stock_includes=immutable_stock_includes, store=store, warm=warm,
+                          archive_format=archive_format)
+
+    build(smbuildfiles, compiler, plugins, packages, flags=flags, output_dir=output_dir, nosource=nosource,
+          jobs=jobs, keep_going=keep_going, include_dirs=include_dirs,
+          immutable_stock_includes=immutable_stock_includes, store=store, link_mode=link_mode,
+          template_cache=template_cache, warm=warm, archive_format=archive_format)
+
+
+def resolve_targets(target):
+    """
+    Returns the list of target directories a build covers, and its output directory.
+    The target is a directory, a workspace file or a list of either. A
+    workspace file lists target directories, one per line, relative to the
+    file (lines starting with # are comments).
+    A single directory builds into its own builds directory, a workspace
+    into the builds directory next to the file, and a list into the builds
+    directory of the current directory.
+    """
+    if isinstance(target, (list, tuple)):
+        if len(target) == 1:
+            return resolve_targets(target[0])
+        targets = []
+        for t in target:
+            for dirname in resolve_targets(t)[0]:
+                if os.path.normpath(dirname) not in [os.path.normpath(d) for d in targets]:
+                    targets.append(dirname)
+        return targets, 'builds'
+
+    if os.path.isfile(target):
+        return read_workspace(target), os.path.join(os.path.dirname(target), 'builds')
+    return [target], os.path.join(target, 'builds')
+
+
+def read_workspace(path):
+    """Returns the target directories listed in a workspace file."""
+    targets = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                targets.append(os.path.join(os.path.dirname(path), line))
+    if not targets:
+        raise ValueError('Workspace file {} does not list any targets'.format(path))
+    return targets
+
+
+def overlay_plan(target, package_name, nosource=False):
+    """
+    Returns the OverlayPlan of a package in a target (see resolve_targets):
+    which file ends up at each path of the package, and which package it
+    comes from. Nothing is built.
+    """
+    targets, output_dir = resolve_targets(target)
+    registry_path = os.path.join(output_dir, STATE_DIR, parser.REGISTRY_NAME)
+    plugins, packages = parser.parse_configs(targets, registry_path)
+    if package_name not in packages:
+        raise ValueError('Package {} does not exist'.format(package_name))
+
+    package = packages[package_name]
+    graph = packagegraph.PackageGraph(packages)
+    include_graph = includescanner.IncludeGraph()
+    for name in graph.plugin_deps(package_name):
+        if name in plugins and plugins[name].source:
+            plugin = plugins[name]
+            plugin.source_files = include_graph.relative_source_files(plugin.source)
+
+    return base.plan_package(package, output_dir, graph, plugins, nosource)
+
+
+def diff_package(old_manifest_path, output_dir='builds', archive_format='tar.gz'):
+    """
+    Writes what changed in a package since the build an older manifest came
+    from: an archive with just the added and changed files, and a list of the
+    removed paths, one per line. Returns a dictionary describing the delta.
+    """
+    old = packagemanifest.load(old_manifest_path)
+    new = packagemanifest.load_built(output_dir, old.package)
+    package_dir = os.path.join(output_dir, old.package)
+
+    added, changed, removed = new.diff(old)
+    entries = [archive.Entry(path, os.path.join(package_dir, *path.split('/'))) for path in added + changed]
+    bundle = os.path.join(output_dir, '{}.delta.{}'.format(old.package, archive_format))
+    archive.write_archive(bundle, entries, archive_format)
+
+    deletions = os.path.join(output_dir, '{}.delta.deleted'.format(old.package))
+    util.write_chunks_if_changed(deletions, [''.join(p + '\n' for p in removed).encode('utf-8')])
+
+    return {
+        'package': old.package,
+        'added': added,
+        'changed': changed,
+        'removed': removed,
+        'bytes': new.size(added + changed),
+        'bundle': bundle,
+        'deletions': deletions,
+    }
+
+
+def build(smbuildfiles, compiler, plugins, packages, flags='', output_dir='builds', nosource=False,
+          jobs=None, keep_going=False, include_dirs=None, immutable_stock_includes=False,
+          store=None, link_mode='copy', template_cache=True, warm=None, archive_format=None):
+    """
+    Performs the entire build process, for the packages of a list of smbuild files.
+    Up to jobs plugins are compiled, or packages created, at once (defaulting to the number of CPUs).
+    """
+    if archive_format:
+        archive.check_format(archive_format)
+
     # setup directory structure, execute user-configurations
     plugin_build_dir = os.path.join(output_dir, 'plugins')
     util.mkdir(output_dir)
     util.mkdir(plugin_build_dir)
 
     # scan deps for what we need to do
+    graph = packagegraph.PackageGraph(packages)
+    packages_to_build, plugins_to_compile = select_targets(smbuildfiles, plugins, packages, graph)
+
+    # compile plugins
+    manifest = open_manifest(output_dir, warm)
+    history = open_history(output_dir, warm)
+    file_cache, include_graph = open_include_graph(output_dir, compiler, include_dirs,
+                                                   immutable_stock_includes, warm)
+    to_compile = [plugins[name] for name in plugins_to_compile]
+    compiled_count = 0
+    try:
+        # scan every include up front, so shared headers are only read once
+        for plugin in to_compile:
+            if plugin.source:
+                include_graph.scan(plugin.source)
+
+        with profiler.span('compile_plugins', 'build', plugins=len(to_compile)):
+            compiled_count = compile_plugins(to_compile, compiler, plugin_build_dir, flags,
+                                             jobs=jobs, keep_going=keep_going, manifest=manifest,
+                                             include_graph=include_graph, store=store,
+                                             history=history)
+    finally:
+        manifest.save()
+        history.save()
+        file_cache.save()
+        if store and compiled_count:
+            store.evict()
+
+    # build packages
+    to_build = [packages[name] for name in packages_to_build]
+    with profiler.span('create_packages', 'build', packages=len(to_build)):
+        with template_cache_dir(output_dir, template_cache):
+            create_packages(to_build, output_dir, graph, plugins, nosource, link_mode, jobs=jobs,
+                            archive_format=archive_format)
+
+    if len(plugins) == 0:
+        util.warning('No plugins were found in {}.'.format(', '.join(smbuildfiles)))
+    elif compiled_count == 0:
+        print('All plugins up to date.')
+
+
+def select_targets(smbuildfiles, plugins, packages, graph):
+    """
+    Returns the sorted names of the packages to build for a list of smbuild
+    files, and of the plugins they (or the smbuild files themselves) need compiled.
+    """
+    # the same file may have been reached through different relative paths
+    smbuildfiles = set(os.path.abspath(f) for f in smbuildfiles)
     packages_to_build = set()
     for name, package in packages.items():
-        if smbuildfile == package.smbuildfile:
+        if os.path.abspath(package.smbuildfile) in smbuildfiles:
             packages_to_build.add(name)
 
     plugins_to_compile = set()
     for name in packages_to_build:
-        for_this_package = base.find_plugin_deps(packages[name], packages)
+        for_this_package = graph.plugin_deps(name)
         for plugin_name in for_this_package:
             plugins_to_compile.add(plugin_name)
 
@@ -43,25 +245,217 @@ def build(smbuildfile, compiler, plugins, packages, flags='', output_dir='builds
                     msg = msg.format(plugin_name, dep, name)
                     util.warning(msg)
 
-    # also compile any plugins from this smbuildfile
+    # also compile any plugins from these smbuild files
     for plugin_name in plugins:
-        if plugins[plugin_name].smbuildfile == smbuildfile:
+        if os.path.abspath(plugins[plugin_name].smbuildfile) in smbuildfiles:
             plugins_to_compile.add(plugin_name)
 
-    # compile plugins
-    compiled_count = 0
+    return sorted(packages_to_build), sorted(plugins_to_compile)
+
+
+@contextlib.contextmanager
+def template_cache_dir(output_dir, template_cache=True):
+    """
+    Keeps compiled templates under the output directory (if template_cache is
+    set) while packages are created. The cache is process-wide, so it is
+    always unset again afterwards.
+    """
+    if template_cache:
+        base.set_template_cache_dir(os.path.join(output_dir, STATE_DIR, 'templates'))
+    else:
+        base.set_template_cache_dir(None)
+    try:
+        yield
+    finally:
+        base.set_template_cache_dir(None)
+
+
+def open_manifest(output_dir, warm=None):
+    """Returns the CompileManifest of a build, from warm if it is given."""
+    path = os.path.join(output_dir, STATE_DIR, compilecache.MANIFEST_NAME)
+    if warm:
+        return warm.manifest(path)
+    return compilecache.CompileManifest(path)
+
+
+def open_history(output_dir, warm=None):
+    """Returns the BuildHistory of a build, from warm if it is given."""
+    path = os.path.join(output_dir, STATE_DIR, buildhistory.HISTORY_NAME)
+    if warm:
+        return warm.history(path)
+    return buildhistory.BuildHistory(path)
+
+
+def open_include_graph(output_dir, compiler, include_dirs=None, immutable_stock_includes=False,
+                       warm=None):
+    """
+    Returns the FileCache and IncludeGraph for a build. System includes are
+    searched for in include_dirs, then in the compiler's own include directory,
+    which is never rescanned if immutable_stock_includes is set.
+    The FileCache comes from warm, if it is given.
+    """
+    path = os.path.join(output_dir, STATE_DIR, filecache.CACHE_NAME)
+    if warm:
+        file_cache = warm.file_cache(path)
+    else:
+        file_cache = filecache.FileCache(path)
+    include_dirs = list(include_dirs or [])
+    immutable_dirs = []
+    stock_dir = includescanner.stock_include_dir(compiler)
+    if stock_dir:
+        include_dirs.append(stock_dir)
+        if immutable_stock_includes:
+            immutable_dirs.append(stock_dir)
+    return file_cache, includescanner.IncludeGraph(file_cache, include_dirs, immutable_dirs)
+
+
+def plan_build(smbuildfiles, compiler, plugins, packages, flags='', output_dir='builds', nosource=False,
+               include_dirs=None, immutable_stock_includes=False, store=None, warm=None,
+               archive_format=None):
+    """
+    Works out everything build would do, without doing any of it.
+    Returns a JSON-friendly dictionary whose 'actions' list has an entry for
+    every compile, copy, render, archive and delete, each with an id, the
+    reasons it is needed, and the ids of any actions it depends on. An up to
+    date build has no actions. Caches come from warm, if it is given, as in build.
+    """
+    plugin_build_dir = os.path.join(output_dir, 'plugins')
+    graph = packagegraph.PackageGraph(packages)
+    packages_to_build, plugins_to_compile = select_targets(smbuildfiles, plugins, packages, graph)
+
+    manifest = open_manifest(output_dir, warm)
+    file_cache, include_graph = open_include_graph(output_dir, compiler, include_dirs,
+                                                   immutable_stock_includes, warm)
+
+    actions = []
+    changed_binaries = {}
     for name in plugins_to_compile:
         plugin = plugins[name]
-        if plugin.compile(compiler, plugin_build_dir, flags):
-            compiled_count += 1
+        binary = os.path.join(plugin_build_dir, name + '.smx')
+        if plugin.binary:
+            action = 'copy'
+            reason = util.sync_reason(plugin.binary, binary)
+            reasons = [reason] if reason else []
+        else:
+            action = 'compile'
+            key, _, _, reasons = plugin.compile_status(compiler, plugin_build_dir, flags,
+                                                       manifest, include_graph)
+            if reasons and store:
+                if store.contains(key):
+                    action = 'fetch'
+                    reasons.append('in plugin store')
+                else:
+                    reasons.append('not in plugin store')
 
-    # build packages
+        if reasons:
+            action_id = '{}:{}'.format(action, name)
+            actions.append({'id': action_id, 'action': action, 'plugin': name,
+                            'reasons': reasons, 'depends_on': []})
+            changed_binaries[binary] = action_id
+
+    changed_plugins = [action['plugin'] for action in actions]
     for name in packages_to_build:
-        package = packages[name]
-        print('Building package {}'.format(name))
-        package.create(output_dir, packages, plugins, nosource)
+        for action in packages[name].plan_actions(output_dir, graph, plugins, nosource, changed_plugins,
+                                                  archive_format, os.path.join(output_dir, STATE_DIR)):
+            action['id'] = '{}:{}:{}'.format(action['action'], name, action['path'])
+            action['package'] = name
+            action['depends_on'] = []
+            if action.get('source') in changed_binaries:
+                action['depends_on'].append(changed_binaries[action['source']])
+            actions.append(action)
 
-    if len(plugins) == 0:
-        util.warning('No plugins were found in {}.'.format(smbuildfile))
-    elif compiled_count == 0:
-        print('All plugins up to date.')
+    return {'actions': actions}
+
+
+def compile_plugins(plugins, compiler, output_dir, flags, jobs=None, keep_going=False,
+                    manifest=None, include_graph=None, store=None, history=None):
+    """
+    Compiles a list of plugins, running up to jobs compiles at once.
+    Each plugin's output is printed together once it finishes, apart from
+    compiler diagnostics, which are printed as they arrive. The first
+    failure stops any compiles that haven't started yet, unless keep_going
+    is set, in which case every plugin is attempted before failing.
+    If a BuildHistory is given, the compiles expected to take longest are
+    started first (see buildhistory.compile_order), and the duration of each
+    compile is recorded in it.
+    Returns the number of plugins that were compiled.
+    """
+    if not jobs:
+        jobs = util.cpu_count()
+    if history:
+        plugins = buildhistory.compile_order(plugins, history)
+
+    compiled_count = 0
+    failed = []
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {}
+        for plugin in plugins:
+            log = []
+            future = executor.submit(_compile_plugin, plugin, compiler, output_dir, flags, log,
+                                     manifest, include_graph, store, history)
+            pending[future] = (plugin, log)
+
+        for future in futures.as_completed(pending):
+            if future.cancelled():
+                continue
+
+            plugin, log = pending[future]
+            try:
+                if future.result():
+                    compiled_count += 1
+            except base.CompileError as e:
+                util.error(str(e), die=False, log=log)
+                failed.append(plugin.name)
+                if not keep_going:
+                    for other in pending:
+                        other.cancel()
+
+            for line in log:
+                print(line)
+
+    if failed:
+        util.error('Failed to compile {} plugin(s): {}'.format(len(failed), ', '.join(sorted(failed))))
+
+    return compiled_count
+
+
+def _compile_plugin(plugin, compiler, output_dir, flags, log, manifest, include_graph, store, history):
+    with profiler.span('compile', 'compile', plugin=plugin.name) as span:
+        start = time.time()
+        compiled = plugin.compile(compiler, output_dir, flags, log, manifest, include_graph, store)
+        # only actual compiles say how long the next one will take
+        if compiled and history:
+            history.record(plugin.name, time.time() - start)
+        span.args['compiled'] = compiled
+        return compiled
+
+
+def create_packages(to_build, output_dir, graph, plugins, nosource, link_mode='copy', jobs=None,
+                    archive_format=None):
+    """
+    Creates packages, up to jobs at once. Every package is attempted, and
+    any errors are reported together at the end.
+    """
+    if not jobs:
+        jobs = util.cpu_count()
+
+    errors = []
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {}
+        for package in to_build:
+            print('Building package {}'.format(package.name))
+            future = executor.submit(package.create, output_dir, graph, plugins, nosource, link_mode,
+                                     archive_format, os.path.join(output_dir, STATE_DIR))
+            pending[future] = package
+
+        for future in futures.as_completed(pending):
+            try:
+                future.result()
+            except Exception as e:
+                # including template errors, which should name their package too
+                errors.append('{}: {}'.format(pending[future].name, e))
+
+    if errors:
+        for e in sorted(errors):
+            util.error(e, die=False)
+        util.error('Failed to build {} package(s)'.format(len(errors)))
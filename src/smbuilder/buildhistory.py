@@ -0,0 +1,80 @@
+import util
+
+import json
+import os
+import threading
+
+
+HISTORY_NAME = 'build_history.json'
+
+# how much the latest compile counts towards a plugin's recorded duration
+DURATION_WEIGHT = 0.5
+
+
+class BuildHistory:
+    """
+    Persistent record of how long each plugin took to compile: a moving
+    average over its recent compiles, used to start the longest compiles first.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.durations = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.durations = json.load(f)
+            except ValueError:
+                util.warning('Ignoring corrupt build history {}'.format(path))
+
+    def duration(self, name):
+        """Returns the recorded compile duration of a plugin, in seconds, or None."""
+        with self.lock:
+            return self.durations.get(name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            previous = self.durations.get(name)
+            if previous is not None:
+                seconds = DURATION_WEIGHT * seconds + (1 - DURATION_WEIGHT) * previous
+            self.durations[name] = seconds
+
+    def save(self):
+        """Writes the history back to disk, if it has a path."""
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps(self.durations, indent=1, sort_keys=True)
+        util.mkdir(os.path.dirname(self.path))
+        util.write_file_atomic(self.path, data.encode('utf-8'))
+
+
+def compile_order(plugins, history):
+    """
+    Returns plugins sorted so the longest compiles come first, by the
+    durations in a BuildHistory. Plugins without one are estimated from the
+    size of their source, at the average rate (seconds per byte) of the
+    plugins that have one, or just ordered by size if none have.
+    """
+    sizes = dict((plugin.name, _source_size(plugin)) for plugin in plugins)
+    durations = dict((plugin.name, history.duration(plugin.name)) for plugin in plugins)
+
+    known = [name for name in durations if durations[name] is not None]
+    known_size = sum(sizes[name] for name in known)
+    rate = sum(durations[name] for name in known) / known_size if known_size else 1
+
+    def estimate(plugin):
+        if durations[plugin.name] is not None:
+            return durations[plugin.name]
+        return sizes[plugin.name] * rate
+
+    return sorted(plugins, key=lambda plugin: (-estimate(plugin), plugin.name))
+
+
+def _source_size(plugin):
+    if not plugin.source:
+        return 0
+    try:
+        return os.path.getsize(plugin.source)
+    except OSError:
+        return 0
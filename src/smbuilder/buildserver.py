@@ -0,0 +1,193 @@
+import buildhistory
+import compilecache
+import filecache
+import parser
+import util
+
+import json
+import os
+import socket
+import socketserver
+import sys
+import tempfile
+
+
+# environment variable overriding where the daemon listens
+SOCKET_ENV = 'SMBUILDER_SOCKET'
+
+
+def default_socket_path():
+    """Returns the daemon's socket path: $SMBUILDER_SOCKET, or one per user in the temp directory."""
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    return os.path.join(tempfile.gettempdir(), 'smbuilder-{}.sock'.format(os.getuid()))
+
+
+class WarmState:
+    """
+    Build state the daemon keeps in memory between commands: the parsed
+    configs of each target, and the compile manifests, build histories and
+    file caches of each output directory. Anything whose files changed on
+    disk since it was loaded (or last saved by a build) is loaded again.
+    """
+    def __init__(self):
+        self.configs = {}
+        self.files = {}
+
+    def parse_configs(self, target):
+        """Returns the (plugins, packages) of a target (or list of targets), see parser.parse_configs."""
+        key = (os.getcwd(), tuple(target) if isinstance(target, list) else target)
+        if key in self.configs:
+            stamps, plugins, packages = self.configs[key]
+            if all(util.file_stat_key(path) == stamp for path, stamp in stamps.items()):
+                return plugins, packages
+
+        plugins, packages = parser.parse_configs(target)
+        # a listed directory's stamp changes when files are added or removed in it
+        paths = set(parser.ConfigFiles) | parser.GlobbedDirs
+        paths.update(os.path.dirname(f) for f in parser.ConfigFiles)
+        stamps = dict((path, util.file_stat_key(path)) for path in paths)
+        self.configs[key] = (stamps, plugins, packages)
+        return plugins, packages
+
+    def manifest(self, path):
+        """Returns the CompileManifest stored at path."""
+        return self._load(path, compilecache.CompileManifest)
+
+    def history(self, path):
+        """Returns the BuildHistory stored at path."""
+        return self._load(path, buildhistory.BuildHistory)
+
+    def file_cache(self, path):
+        """Returns the FileCache stored at path."""
+        return self._load(path, filecache.FileCache)
+
+    def saved(self):
+        """Records the files of every held manifest and cache as up to date, after a build saved them."""
+        for path, held in self.files.items():
+            held[1] = util.file_stat_key(path)
+
+    def _load(self, path, cls):
+        held = self.files.get(path)
+        if held and held[1] == util.file_stat_key(path):
+            return held[0]
+        loaded = cls(path)
+        self.files[path] = [loaded, util.file_stat_key(path)]
+        return loaded
+
+
+def send(wfile, message):
+    """Writes a message of the daemon protocol: a line of JSON."""
+    wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+    wfile.flush()
+
+
+class _OutputStream:
+    """A file-like object sending what is written to it to a client, as output messages."""
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.connected = True
+
+    def write(self, text):
+        # if the client went away, the command still runs to completion
+        if text and self.connected:
+            try:
+                send(self.wfile, {'output': text})
+            except (IOError, OSError):
+                self.connected = False
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+
+        stream = _OutputStream(self.wfile)
+        status = self.server.run(request['argv'], request['cwd'], stream)
+        if stream.connected:
+            try:
+                send(self.wfile, {'status': status})
+            except (IOError, OSError):
+                pass
+
+
+class BuildServer(socketserver.UnixStreamServer):
+    """
+    Runs smbuilder commands sent over a Unix socket, one at a time, in a
+    process that keeps a WarmState between them.
+
+    A client sends a single line of JSON, {"argv": [...], "cwd": "..."}, and
+    receives lines of JSON back: {"output": "..."} for everything the command
+    prints, then {"status": n} with its exit status.
+    The handler is called with the arguments and the WarmState to run a command.
+    """
+    def __init__(self, path, handler):
+        self.handler = handler
+        self.warm = WarmState()
+        socketserver.UnixStreamServer.__init__(self, path, _RequestHandler)
+        # commands run as the daemon's user, so nobody else may send them
+        os.chmod(path, 0o600)
+
+    def run(self, argv, cwd, stream):
+        """Runs a command in cwd with its output sent to stream, and returns its exit status."""
+        old_cwd = os.getcwd()
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = stream
+        status = 0
+        try:
+            os.chdir(cwd)
+            self.handler(argv, self.warm)
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code is not None:
+                print(e.code)
+                status = 1
+        except Exception as e:
+            util.error(str(e), die=False)
+            status = 1
+        finally:
+            self.warm.saved()
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            os.chdir(old_cwd)
+        return status
+
+
+def serve(handler, path=None):
+    """Runs a BuildServer on path (default_socket_path by default) until interrupted."""
+    path = path or default_socket_path()
+    if os.path.exists(path):
+        if _is_listening(path):
+            raise ValueError('A daemon is already listening on {}'.format(path))
+        # left behind by a daemon that died
+        os.remove(path)
+
+    server = BuildServer(path, handler)
+    print('smbuilder daemon listening on {}'.format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def _is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except (IOError, OSError):
+        return False
+    finally:
+        sock.close()
@@ -0,0 +1,88 @@
+import util
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+
+MANIFEST_NAME = 'compile_manifest.json'
+
+_compiler_ids = {}
+_compiler_ids_lock = threading.Lock()
+
+
+class CompileManifest:
+    """
+    Persistent record of what each plugin was last compiled from.
+    Maps plugin names to the hash of their compile inputs, the per-file
+    digests of those inputs, and the diagnostics the compiler printed
+    (see compiledriver.Diagnostic).
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                util.warning('Ignoring corrupt compile manifest {}'.format(path))
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def update(self, name, entry):
+        with self.lock:
+            self.entries[name] = entry
+
+    def remove(self, name):
+        with self.lock:
+            self.entries.pop(name, None)
+
+    def save(self):
+        """Writes the manifest back to disk, if it has a path."""
+        if not self.path:
+            return
+        with self.lock:
+            data = json.dumps(self.entries, indent=1, sort_keys=True)
+        util.mkdir(os.path.dirname(self.path))
+        util.write_file_atomic(self.path, data.encode('utf-8'))
+
+
+def compiler_identity(compiler):
+    """
+    Returns a string identifying the compiler binary: a digest of its
+    contents if it can be found, otherwise the command itself.
+    The digest is memoized for as long as the binary's stat is unchanged,
+    so a long-running process notices when the compiler is replaced.
+    """
+    path = shutil.which(compiler) or compiler
+    if not os.path.isfile(path):
+        return compiler
+
+    key = (os.path.realpath(path),) + tuple(util.stat_key(os.stat(path)))
+    with _compiler_ids_lock:
+        if key in _compiler_ids:
+            return _compiler_ids[key]
+
+    identity = util.file_digest(path)
+    with _compiler_ids_lock:
+        _compiler_ids[key] = identity
+    return identity
+
+
+def compile_key(input_digests, flags, compiler_id):
+    """
+    Returns the hash of everything that determines a compile's output:
+    the digests of the source and its includes, the flags and the compiler.
+    """
+    h = hashlib.sha256()
+    for path in sorted(input_digests):
+        h.update('{}\0{}\0'.format(path, input_digests[path]).encode('utf-8'))
+    h.update('flags\0{}\0'.format(flags).encode('utf-8'))
+    h.update('compiler\0{}\0'.format(compiler_id).encode('utf-8'))
+    return h.hexdigest()
@@ -0,0 +1,134 @@
+import util
+
+import asyncio
+import re
+import shlex
+import threading
+
+
+# spcomp reports problems as: path/plugin.sp(12) : warning 203: symbol is never used: "x"
+# (a problem spanning several lines gives a range, as in plugin.sp(12 -- 14))
+DIAGNOSTIC_PATTERN = re.compile(
+    r'^(?P<file>.+?)\((?P<line>\d+)(?:\s*--\s*\d+)?\)\s*:\s*'
+    r'(?P<severity>fatal error|error|warning)\s*(?P<code>\d+)?\s*:\s*(?P<message>.*)$')
+
+# streamed lines come from several compiles at once
+_output_lock = threading.Lock()
+
+
+class Diagnostic:
+    """A warning or error the compiler reported, with the line of output it came from."""
+    def __init__(self, file, line, severity, code, message, text):
+        self.file = file
+        self.line = line
+        self.severity = severity
+        self.code = code
+        self.message = message
+        self.text = text
+
+    def to_dict(self):
+        return {
+            'file': self.file,
+            'line': self.line,
+            'severity': self.severity,
+            'code': self.code,
+            'message': self.message,
+            'text': self.text,
+        }
+
+    @staticmethod
+    def from_dict(data):
+        return Diagnostic(data['file'], data['line'], data['severity'], data['code'],
+                          data['message'], data['text'])
+
+
+class CompileResult:
+    """The outcome of a compiler run: its exit status, its diagnostics, and the rest of its output."""
+    def __init__(self):
+        self.returncode = None
+        self.diagnostics = []
+        self.output = []
+
+    def text(self):
+        """Returns the diagnostics as the compiler printed them, one per line."""
+        return '\n'.join(d.text for d in self.diagnostics)
+
+
+def parse_diagnostic(line):
+    """Returns the Diagnostic a line of compiler output holds, or None if it isn't one."""
+    match = DIAGNOSTIC_PATTERN.match(line.strip())
+    if not match:
+        return None
+    return Diagnostic(match.group('file'), int(match.group('line')), match.group('severity'),
+                      match.group('code'), match.group('message'), line.strip())
+
+
+def parse_diagnostics(text):
+    """Returns the Diagnostics in some compiler output, skipping any other lines."""
+    diagnostics = []
+    for line in (text or '').splitlines():
+        diagnostic = parse_diagnostic(line)
+        if diagnostic:
+            diagnostics.append(diagnostic)
+    return diagnostics
+
+
+def compiler_argv(compiler, source, flags, out, include_dirs):
+    """
+    Returns the arguments to run the compiler with. The compiler and paths
+    are passed as they are, only the flags are split (as a shell would).
+    """
+    argv = [compiler, source] + shlex.split(flags or '') + ['-o=' + out]
+    return argv + ['-i=' + include_dir for include_dir in include_dirs]
+
+
+def report(name, diagnostics, log=None):
+    """
+    Shows diagnostics, prefixed with the name of the plugin they are for.
+    If a log list is given, they are appended to it instead.
+    """
+    for diagnostic in diagnostics:
+        text = '[{}] {}'.format(name, diagnostic.text)
+        with _output_lock:
+            if diagnostic.severity == 'warning':
+                util.warning(text, log)
+            else:
+                util.error(text, die=False, log=log)
+
+
+def run(argv, name):
+    """
+    Runs the compiler, reading its stdout and stderr through pipes.
+    The command line is printed as the compile starts, and diagnostics as
+    soon as they are printed (see report); the rest of the output is kept in
+    the result. Returns a CompileResult.
+    Raises an OSError if the compiler can't be started.
+    """
+    with _output_lock:
+        util.output(' '.join(shlex.quote(arg) for arg in argv))
+    return asyncio.run(_run(argv, name))
+
+
+async def _run(argv, name):
+    process = await asyncio.create_subprocess_exec(
+        *argv, stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    result = CompileResult()
+    await asyncio.gather(_read_lines(process.stdout, name, result),
+                         _read_lines(process.stderr, name, result))
+    result.returncode = await process.wait()
+    return result
+
+
+async def _read_lines(stream, name, result):
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        line = line.decode('utf-8', 'replace').rstrip()
+        diagnostic = parse_diagnostic(line)
+        if diagnostic:
+            result.diagnostics.append(diagnostic)
+            report(name, [diagnostic])
+        elif line:
+            result.output.append(line)
@@ -0,0 +1,93 @@
+import packagemanifest
+import util
+
+from concurrent import futures
+import os
+
+
+# where, under a destination, what each package deployed there is recorded
+STATE_DIR_NAME = '.smbuilder-deploy'
+
+
+def state_path(dest, package_name):
+    """Returns the file recording what a package last deployed to a destination."""
+    return os.path.join(dest, STATE_DIR_NAME, package_name + '.json')
+
+
+def deploy_package(package_name, dest, output_dir='builds', jobs=None):
+    """
+    Syncs a built package directory into a destination directory (such as a
+    server install), using the package's manifest and the state recorded by
+    the last deploy instead of rescanning the destination: only files whose
+    content changed, or which were changed at the destination since, are
+    copied, up to jobs at once, each renamed into place atomically. Files the
+    package deployed before but no longer contains are removed; other files
+    at the destination are never touched.
+    Returns the sorted (copied, removed) paths.
+    """
+    manifest = packagemanifest.load_built(output_dir, package_name)
+    package_dir = os.path.join(output_dir, package_name)
+    state_file = state_path(dest, package_name)
+    previous = packagemanifest.load_previous(state_file) or packagemanifest.PackageManifest(package_name)
+    state = packagemanifest.PackageManifest(package_name)
+
+    to_copy = []
+    for path, entry in manifest.files.items():
+        if previous.files.get(path) == entry and previous.stats.get(path) == _stat(dest, path):
+            state.files[path] = entry
+            state.stats[path] = previous.stats[path]
+        else:
+            to_copy.append(path)
+
+    if not jobs:
+        jobs = util.cpu_count()
+
+    errors = []
+    with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {}
+        for path in to_copy:
+            src = os.path.join(package_dir, *path.split('/'))
+            future = executor.submit(util.place_file, src, os.path.join(dest, *path.split('/')))
+            pending[future] = path
+
+        for future in futures.as_completed(pending):
+            path = pending[future]
+            try:
+                future.result()
+                state.files[path] = manifest.files[path]
+                state.stats[path] = _stat(dest, path)
+            except (IOError, OSError) as e:
+                errors.append('{}: {}'.format(path, e))
+
+    removed = sorted(p for p in previous.files if p not in manifest.files)
+    for path in removed:
+        _remove(dest, path)
+
+    util.mkdir(os.path.dirname(state_file))
+    state.save(state_file)
+
+    if errors:
+        for e in sorted(errors):
+            util.error(e, die=False)
+        raise IOError('Failed to copy {} file(s) of package {}'.format(len(errors), package_name))
+
+    return sorted(to_copy), removed
+
+
+def _stat(dest, path):
+    return util.file_stat_key(os.path.join(dest, *path.split('/')))
+
+
+def _remove(dest, path):
+    """Removes a deployed file, and any of its directories that are left empty."""
+    filename = os.path.join(dest, *path.split('/'))
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    dirname = os.path.dirname(filename)
+    while os.path.abspath(dirname) != os.path.abspath(dest):
+        try:
+            os.rmdir(dirname)
+        except OSError:
+            break
+        dirname = os.path.dirname(dirname)
@@ -0,0 +1,74 @@
+import includescanner
+import util
+
+import json
+import os
+import threading
+
+
+CACHE_NAME = 'file_cache.json'
+
+
+class FileCache:
+    """
+    Persistent per-file data (parsed include directives, content digests),
+    keyed by path and discarded whenever the file's size, mtime or inode
+    changes. With a warm cache, scanning an unchanged file only costs a stat.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.dirty = False
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                util.warning('Ignoring corrupt file cache {}'.format(path))
+
+    def stat(self, filename):
+        """Returns the (size, mtime, inode) key of a file."""
+        return util.stat_key(os.stat(filename))
+
+    def mtime(self, filename):
+        """Returns the modification time of a file, in seconds."""
+        return self._entry(filename)['stat'][1] / 1e9
+
+    def includes(self, filename):
+        """Returns the include directives of a file, see includescanner.parse_includes."""
+        return self._field(filename, 'includes', includescanner.parse_includes)
+
+    def digest(self, filename):
+        """Returns the sha256 hex digest of a file's contents."""
+        return self._field(filename, 'digest', util.file_digest)
+
+    def save(self):
+        """Writes the cache back to disk, if it has a path and changed."""
+        if not self.path or not self.dirty:
+            return
+        with self.lock:
+            data = json.dumps(self.entries, separators=(',', ':'), sort_keys=True)
+            self.dirty = False
+        util.mkdir(os.path.dirname(self.path))
+        util.write_file_atomic(self.path, data.encode('utf-8'))
+
+    def _entry(self, filename):
+        path = os.path.abspath(filename)
+        key = self.stat(path)
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is None or entry['stat'] != key:
+                entry = {'stat': key}
+                self.entries[path] = entry
+                self.dirty = True
+            return entry
+
+    def _field(self, filename, field, compute):
+        entry = self._entry(filename)
+        if field not in entry:
+            value = compute(filename)
+            with self.lock:
+                entry[field] = value
+                self.dirty = True
+        return entry[field]
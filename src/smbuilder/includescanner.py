@@ -1,58 +1,264 @@
+import filecache
+import profiler
 import util
 
 import os
+import shutil
+import threading
 
 
-# TODO: guard against infinite loops (detect cycles early)
-def find_last_time_modified(filename):
+# digest recorded for includes that are never read (see IncludeGraph)
+IMMUTABLE_DIGEST = 'immutable'
+
+
+class IncludeGraph:
+    """
+    Include graph shared by every plugin in a build.
+    Each file is parsed once, and the latest change time and transitive set
+    of files for every node are memoized, so shared headers are only walked
+    the first time any plugin reaches them. Include cycles are errors.
+
+    System includes (#include <...>) are resolved against include_dirs, in
+    order, the same way the compiler's -i paths are. Each directory is
+    indexed once into a name -> path map. Files found in one of the
+    immutable_dirs (e.g. the SourceMod stock includes) are assumed to never
+    change, so they are neither read nor stat'd.
+    """
+    def __init__(self, cache=None, include_dirs=None, immutable_dirs=None):
+        if cache is None:
+            cache = filecache.FileCache()
+        self.cache = cache
+        self.include_dirs = list(include_dirs or [])
+        self.immutable_dirs = set(os.path.abspath(d) for d in immutable_dirs or [])
+        self.lock = threading.RLock()
+        self.edges = {}
+        self.latest = {}
+        self.closures = {}
+        self.index = None
+        self.system_names = {}
+        self.immutable = set()
+        # paths that didn't exist -> the files whose includes would have used them
+        self.missing = {}
+
+    def scan(self, filename):
+        """Adds a file and everything it includes to the graph."""
+        path = os.path.abspath(filename)
+        with profiler.span('scan_includes', 'includes', source=os.path.basename(path)) as span:
+            with self.lock:
+                self._visit(path, [])
+                span.args['files'] = len(self.closures[path])
+
+    def invalidate(self, paths):
+        """
+        Forgets the given changed, added or removed files, and every file
+        that includes them, so they are scanned again when next used.
+        """
+        paths = set(os.path.abspath(p) for p in paths)
+        with self.lock:
+            if any(self._changes_index(path) for path in paths):
+                # a system include appeared or went away, so start over
+                stale = set(self.closures)
+                self.index = None
+                self.system_names = {}
+                self.immutable = set()
+            else:
+                stale = set(path for path in paths if path in self.closures)
+                for path in paths:
+                    stale.update(self.missing.pop(path, ()))
+
+            for path in [p for p in self.closures if self.closures[p] & stale]:
+                del self.closures[path]
+                del self.edges[path]
+                del self.latest[path]
+
+    def latest_change(self, filename):
+        """Returns the latest time the file or anything it includes was modified."""
+        path = os.path.abspath(filename)
+        with self.lock:
+            self._visit(path, [])
+            return self.latest[path]
+
+    def source_files(self, filename):
+        """Returns the set of absolute paths of a file and everything it includes."""
+        path = os.path.abspath(filename)
+        with self.lock:
+            self._visit(path, [])
+            return self.closures[path]
+
+    def relative_source_files(self, filename):
+        """
+        Returns source_files relative to the directory of the given file,
+        leaving out any system includes.
+        """
+        base = os.path.dirname(os.path.abspath(filename))
+        files = self.source_files(filename)
+        return set(os.path.relpath(f, base) for f in files if f not in self.system_names)
+
+    def input_digests(self, filename):
+        """
+        Returns a dictionary of every file a source file depends on to its
+        content digest. Local files are named relative to the source file's
+        directory, system includes by their <include> name, so the result
+        doesn't depend on where the include directories live.
+        """
+        base = os.path.dirname(os.path.abspath(filename))
+        digests = {}
+        for path in self.source_files(filename):
+            if path in self.system_names:
+                name = self.system_names[path]
+            else:
+                name = os.path.relpath(path, base)
+
+            if path in self.immutable:
+                digests[name] = IMMUTABLE_DIGEST
+            else:
+                digests[name] = self.cache.digest(path)
+        return digests
+
+    def _visit(self, path, stack):
+        if path in self.closures:
+            return
+
+        if path in self.immutable:
+            self.edges[path] = []
+            self.latest[path] = 0
+            self.closures[path] = frozenset([path])
+            return
+
+        if path in stack:
+            cycle = stack[stack.index(path):] + [path]
+            util.error('Include cycle detected: {}'.format(' -> '.join(cycle)))
+
+        try:
+            latest_time = self.cache.mtime(path)
+            includes = self.cache.includes(path)
+        except (IOError, OSError) as e:
+            print(e)
+            util.error('Missing file: {}'.format(path))
+
+        stack.append(path)
+        closure = set([path])
+        children = []
+        for include_file, optional in self._resolve(path, includes):
+            if include_file not in self.system_names and not os.path.exists(include_file):
+                if not optional:
+                    util.error('Missing file: {}\n\tincluded from {}'.format(include_file, path))
+                continue
+
+            children.append(include_file)
+            self._visit(include_file, stack)
+            latest_time = max(latest_time, self.latest[include_file])
+            closure.update(self.closures[include_file])
+        stack.pop()
+
+        self.edges[path] = children
+        self.latest[path] = latest_time
+        self.closures[path] = frozenset(closure)
+
+    def _changes_index(self, path):
+        """Returns whether a changed path was added to or removed from an include directory."""
+        if self.index is None:
+            return False
+        if not any(path.startswith(os.path.abspath(d) + os.sep) for d in self.include_dirs):
+            return False
+        indexed = any(path == indexed_path for indexed_path, _ in self.index.values())
+        return os.path.exists(path) != indexed
+
+    def _resolve(self, path, includes):
+        """Yields (absolute path, optional) pairs for the includes of a file."""
+        for arg, optional in includes:
+            if arg.startswith('<'):
+                include_name = _with_extension(arg.strip('<>'))
+                system_file = self._find_system_include(include_name)
+                # anything not found is left for the compiler to report
+                if system_file:
+                    yield system_file, optional
+
+            elif arg.startswith('\"'):
+                include_name = _with_extension(arg.replace('\"', ''))
+                include_file = os.path.join(os.path.dirname(path), include_name)
+                include_file = os.path.normpath(include_file)
+
+                # like the compiler, fall back to the include directories
+                if not os.path.exists(include_file):
+                    self.missing.setdefault(include_file, set()).add(path)
+                    include_file = self._find_system_include(include_name) or include_file
+
+                yield include_file, optional
+
+    def _find_system_include(self, include_name):
+        """Returns the absolute path of a system include, or None if there isn't one."""
+        if self.index is None:
+            self.index = {}
+            for include_dir in reversed(self.include_dirs):
+                self.index.update(_index_directory(include_dir))
+
+        name = os.path.normpath(include_name)
+        if name not in self.index:
+            return None
+
+        path, include_dir = self.index[name]
+        self.system_names[path] = '<{}>'.format(name)
+        if include_dir in self.immutable_dirs:
+            self.immutable.add(path)
+        return path
+
+
+def _with_extension(include_name):
+    # dirty hack to allow include of things without filenames
+    name, extension = os.path.splitext(include_name)
+    if not extension:
+        include_name += '.inc'
+    return include_name
+
+
+def _index_directory(include_dir):
+    """Returns a dictionary of include names -> (absolute path, directory) under a directory."""
+    include_dir = os.path.abspath(include_dir)
+    index = {}
+    for root, dirs, files in os.walk(include_dir):
+        for f in files:
+            path = os.path.join(root, f)
+            index[os.path.relpath(path, include_dir)] = (path, include_dir)
+    return index
+
+
+def stock_include_dir(compiler):
+    """
+    Returns the include directory that ships next to the compiler,
+    which the compiler always searches, or None if there isn't one.
+    """
+    compiler_path = shutil.which(compiler)
+    if not compiler_path:
+        return None
+    include_dir = os.path.join(os.path.dirname(os.path.realpath(compiler_path)), 'include')
+    if os.path.isdir(include_dir):
+        return include_dir
+    return None
+
+
+def find_last_time_modified(filename, cache=None):
     """
     Finds the latest time this source file was modified,
-    including all includes.
-    """
-    visited = set([filename])
-    time = _find_last_time_modified(filename, visited)
-    base = os.path.dirname(filename)
-    visited = map(lambda f: os.path.relpath(f, base), visited)
-    return time, visited
-
-
-def _find_last_time_modified(filename, visited):
-    try:
-        latest_time = os.path.getmtime(filename)
-        with open(filename) as f:
-            to_read = []
-            lines = f.read().split('\n')
-            for line in lines:
-                optional = '#tryinclude' in line
-                if '#include' in line or optional:
-                    arg = line.split(' ')[1].strip()
-                    if not arg:
-                        pass
-                    elif arg.startswith('<'):
-                        # TODO: also read system includes
-                        pass
-                    elif arg.startswith('\"'):
-                        include_file = arg.replace('\"', '')
-                        include_file = os.path.join(os.path.dirname(filename), include_file)
-
-                        # dirty hack to allow include of things without filenames
-                        name, extension = os.path.splitext(include_file)
-                        if not extension:
-                            include_file += '.inc'
-
-                        to_read.append((include_file, optional))
-                        if os.path.exists(include_file):
-                            visited.add(include_file)
-
-            for file, optional in to_read:
-                if not os.path.exists(file) and not optional:
-                    util.error('Missing file: {}\n\tincluded from {}'.format(file, filename))
-
-                if os.path.exists(file):
-                    latest_time = max(latest_time, _find_last_time_modified(file, visited))
-
-        return latest_time
-
-    except OSError as e:
-        print(e)
-        util.error('Missing file: {}'.format(filename))
+    including all includes. Also returns the set of files
+    involved, relative to the source file's directory.
+    """
+    graph = IncludeGraph(cache)
+    return graph.latest_change(filename), graph.relative_source_files(filename)
+
+
+def parse_includes(filename):
+    """
+    Returns the include directives of a file, as a list of
+    (argument, optional) pairs, e.g. ('"myinclude.inc"', False).
+    """
+    includes = []
+    with open(filename) as f:
+        lines = f.read().split('\n')
+        for line in lines:
+            optional = '#tryinclude' in line
+            if '#include' in line or optional:
+                arg = line.split(' ')[1].strip()
+                if arg:
+                    includes.append((arg, optional))
+    return includes
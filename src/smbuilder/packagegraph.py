@@ -0,0 +1,99 @@
+import threading
+
+
+class PackageGraph:
+    """
+    The packages of a build, resolved once after parsing.
+    Packages are topologically ordered (bases first), and each package's
+    flattened extends chain, plugin closure and merged template arguments
+    are memoized, so diamond-shaped hierarchies are only walked once.
+    Raises a ValueError for a package cycle or a missing base package.
+    """
+    def __init__(self, packages):
+        self.packages = packages
+        self.order = []
+        self.resolved = set()
+        self.lock = threading.RLock()
+        self._layers = {}
+        self._plugin_deps = {}
+        self._template_args = {}
+        self._template_files = {}
+
+        for name in sorted(packages):
+            self._visit(name, [])
+
+    def layers(self, name):
+        """
+        Returns the names of a package and everything it extends, bases first.
+        Each package appears once, after all of its own bases, so a package
+        overrides anything it extends, even through diamonds.
+        """
+        with self.lock:
+            if name not in self._layers:
+                layers = []
+                for base_name in self.packages[name].extends_list:
+                    for layer in self.layers(base_name):
+                        if layer not in layers:
+                            layers.append(layer)
+                layers.append(name)
+                self._layers[name] = layers
+            return self._layers[name]
+
+    def plugin_deps(self, name):
+        """Returns the set of plugin names a package includes, with those of its bases."""
+        with self.lock:
+            if name not in self._plugin_deps:
+                deps = set(self.packages[name].plugins)
+                for base_name in self.packages[name].extends_list:
+                    deps.update(self.plugin_deps(base_name))
+                self._plugin_deps[name] = frozenset(deps)
+            return self._plugin_deps[name]
+
+    def template_args(self, name, plugins):
+        """
+        Returns the template arguments of a package: those of each layer of
+        its extends chain, later layers overriding earlier ones, plus the
+        special plugin_binaries and package arguments.
+        """
+        with self.lock:
+            if name not in self._template_args:
+                args = {}
+                for layer in self.layers(name):
+                    args.update(self.packages[layer].template_args)
+
+                plugin_binaries = []
+                for dep in sorted(self.plugin_deps(name)):
+                    plugin_binaries.append(plugins[dep].name + '.smx')
+                args['plugin_binaries'] = plugin_binaries
+                args['package'] = name
+                self._template_args[name] = args
+            return self._template_args[name]
+
+    def template_files(self, name):
+        """Returns the template file globs declared by a package or any of its bases."""
+        with self.lock:
+            if name not in self._template_files:
+                template_files = []
+                for layer in self.layers(name):
+                    for pattern in self.packages[layer].template_files:
+                        if pattern not in template_files:
+                            template_files.append(pattern)
+                self._template_files[name] = template_files
+            return self._template_files[name]
+
+    def _visit(self, name, stack):
+        if name in self.resolved:
+            return
+        if name in stack:
+            cycle = stack[stack.index(name):] + [name]
+            raise ValueError('Package cycle detected: {}'.format(' -> '.join(cycle)))
+
+        stack.append(name)
+        for base_name in self.packages[name].extends_list:
+            if base_name not in self.packages:
+                err_msg = 'Package {} extends non-existent package {}'
+                raise ValueError(err_msg.format(name, base_name))
+            self._visit(base_name, stack)
+        stack.pop()
+        self.order.append(name)
+        self.resolved.add(name)
@@ -0,0 +1,98 @@
+import util
+
+import hashlib
+import json
+import os
+
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def manifest_path(output_dir, package_name):
+    """Returns where the manifest of a package is written, next to its output."""
+    return os.path.join(output_dir, package_name + MANIFEST_SUFFIX)
+
+
+class PackageManifest:
+    """
+    The files of a built package: the size and sha256 of each path (relative
+    to the package), used to work out what changed between two builds.
+    The stat of each file hashed is kept too, so an unchanged file is only
+    hashed once. archive_format is set when the package was written as an
+    archive, in which case its directory (if any) is left over from an
+    older build.
+    """
+    def __init__(self, package, files=None, stats=None, archive_format=None):
+        self.package = package
+        self.files = files or {}
+        self.stats = stats or {}
+        self.archive_format = archive_format
+
+    def add_file(self, path, filename, previous=None):
+        """Adds a file, reusing its hash from a previous manifest if the file is unchanged."""
+        st = os.stat(filename)
+        stat = util.stat_key(st)
+        path = path.replace(os.sep, '/')
+        if previous and previous.stats.get(path) == stat and path in previous.files:
+            self.files[path] = previous.files[path]
+        else:
+            self.files[path] = {'size': st.st_size, 'sha256': util.file_digest(filename)}
+        self.stats[path] = stat
+
+    def add_data(self, path, data):
+        """Adds a file that has the given bytes."""
+        path = path.replace(os.sep, '/')
+        self.files[path] = {'size': len(data), 'sha256': hashlib.sha256(data).hexdigest()}
+        self.stats.pop(path, None)
+
+    def diff(self, old):
+        """Returns the sorted (added, changed, removed) paths since an older manifest."""
+        added = sorted(p for p in self.files if p not in old.files)
+        changed = sorted(p for p in self.files if p in old.files and self.files[p] != old.files[p])
+        removed = sorted(p for p in old.files if p not in self.files)
+        return added, changed, removed
+
+    def size(self, paths):
+        return sum(self.files[p]['size'] for p in paths)
+
+    def save(self, path):
+        """Writes the manifest to a file, unless the file already has the same content."""
+        data = json.dumps({'package': self.package, 'files': self.files, 'stats': self.stats,
+                           'archive': self.archive_format}, indent=1, sort_keys=True)
+        util.write_chunks_if_changed(path, [data.encode('utf-8')])
+
+
+def load(path):
+    """Reads a PackageManifest, raising a ValueError if the file isn't one."""
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except ValueError:
+            data = None
+    if not isinstance(data, dict) or 'package' not in data or 'files' not in data:
+        raise ValueError('{} is not a package manifest'.format(path))
+    return PackageManifest(data['package'], data['files'], data.get('stats'), data.get('archive'))
+
+
+def load_built(output_dir, package_name):
+    """
+    Returns the PackageManifest of a package built as a directory in
+    output_dir, raising a ValueError if it wasn't (or was last built as an
+    archive, so the directory doesn't match the manifest).
+    """
+    path = manifest_path(output_dir, package_name)
+    if not os.path.exists(path):
+        raise ValueError('Package {} has not been built in {}'.format(package_name, output_dir))
+    manifest = load(path)
+    if manifest.archive_format or not os.path.isdir(os.path.join(output_dir, package_name)):
+        msg = 'Package {} was built as an archive, build it without --archive first'
+        raise ValueError(msg.format(package_name))
+    return manifest
+
+
+def load_previous(path):
+    """Returns the PackageManifest at path, or None if there isn't a readable one."""
+    try:
+        return load(path)
+    except (IOError, OSError, ValueError):
+        return None
@@ -1,32 +1,119 @@
 import base
+import packagegraph
+import profiler
 import util
 
 import fnmatch
 import glob
 import os
+import pickle
 
 
 CONFIG_NAME = 'smbuild'
+REGISTRY_NAME = 'registry.pickle'
+# bumped whenever the cached registry's layout (or the containers) change
+REGISTRY_VERSION = 2
+ConfigFiles = []
+GlobbedDirs = set()
 IncludedPaths = set()
 Packages = {}
 Plugins = {}
 DirectoryStack = []
 
 
-def parse_configs(config_dir):
+def parse_configs(config_dir, cache_path=None):
     """
     Exectues a smbuild configuration file in the given directory and
     builds the global data structures needed.
     (i.e. the Plugins and Packages dictionaries)
+    config_dir may also be a list of directories, whose smbuild files are
+    all executed into the same dictionaries. A file that was already
+    executed, as a target or through an Include, isn't executed again.
+    If cache_path is given, the results are saved there, and reused for as
+    long as the smbuild files and the listings of the directories they
+    globbed stay the same.
     """
-    global DirectoryStack, Packages, Plugins, IncludedPaths
-    IncludedPaths = set()
-    Plugins = {}
-    Packages = {}
-    DirectoryStack = [config_dir]
-    execute_config(config_dir)
-    check_package_cycles(Packages)
-    return Plugins, Packages
+    global DirectoryStack, Packages, Plugins, IncludedPaths, ConfigFiles, GlobbedDirs
+    with profiler.span('parse_configs', 'parse', target=config_dir, cached=False) as span:
+        cached = None
+        if cache_path:
+            cached = load_registry(cache_path, config_dir)
+
+        if cached:
+            ConfigFiles, GlobbedDirs, Plugins, Packages = cached
+            span.args['cached'] = True
+        else:
+            ConfigFiles = []
+            GlobbedDirs = set()
+            IncludedPaths = set()
+            Plugins = {}
+            Packages = {}
+            for dirname in config_dir if isinstance(config_dir, list) else [config_dir]:
+                abspath = os.path.abspath(dirname)
+                if abspath not in IncludedPaths:
+                    IncludedPaths.add(abspath)
+                    DirectoryStack = [dirname]
+                    execute_config(dirname)
+            check_package_cycles(Packages)
+            if cache_path:
+                save_registry(cache_path, config_dir)
+
+        span.args['files'] = len(ConfigFiles)
+        return Plugins, Packages
+
+
+def registry_inputs(config_files, globbed_dirs):
+    """
+    Returns what parsing depends on: the digest of each config file, and
+    the listing of each globbed directory (None for those that don't exist).
+    """
+    digests = {}
+    for filename in config_files:
+        digests[filename] = util.file_digest(filename) if os.path.isfile(filename) else None
+
+    listings = {}
+    for dirname in globbed_dirs:
+        listings[dirname] = sorted(os.listdir(dirname)) if os.path.isdir(dirname) else None
+
+    return {'configs': digests, 'listings': listings}
+
+
+def save_registry(path, config_dir):
+    """Saves the current Plugins and Packages, with what they were parsed from, to a file."""
+    registry = {
+        'version': REGISTRY_VERSION,
+        'cwd': os.getcwd(),
+        'config_dir': config_dir,
+        'inputs': registry_inputs(ConfigFiles, GlobbedDirs),
+        'config_files': ConfigFiles,
+        'globbed_dirs': GlobbedDirs,
+        'plugins': Plugins,
+        'packages': Packages,
+    }
+    util.mkdir(os.path.dirname(path))
+    util.write_file_atomic(path, pickle.dumps(registry, pickle.HIGHEST_PROTOCOL))
+
+
+def load_registry(path, config_dir):
+    """
+    Returns the (config files, globbed dirs, plugins, packages) saved to a file
+    by save_registry, or None if there are none or they are out of date.
+    """
+    try:
+        with open(path, 'rb') as f:
+            registry = pickle.load(f)
+    except Exception:
+        return None
+
+    if not isinstance(registry, dict) or registry.get('version') != REGISTRY_VERSION:
+        return None
+    if registry['cwd'] != os.getcwd() or registry['config_dir'] != config_dir:
+        return None
+    inputs = registry['inputs']
+    if inputs != registry_inputs(inputs['configs'], inputs['listings']):
+        return None
+
+    return registry['config_files'], registry['globbed_dirs'], registry['plugins'], registry['packages']
 
 
 def glob_plugins(pattern):
@@ -36,6 +123,7 @@ def glob_plugins(pattern):
     """
     path = os.path.join(*DirectoryStack)
     results = glob.glob(os.path.join(path, pattern))
+    record_glob(os.path.join(path, pattern))
     for source_file in results:
         register_plugin(source=source_file)
 
@@ -50,6 +138,7 @@ def execute_config(dir_path):
     """
     filename = os.path.abspath(os.path.join(dir_path, CONFIG_NAME))
     if os.path.exists(filename):
+        ConfigFiles.append(filename)
         context = {
             'Include': register_include,
             'Plugin': register_plugin,
@@ -58,12 +147,13 @@ def execute_config(dir_path):
             'Plugins': list_glob_plugins,
         }
         with open(filename) as f:
-            exec(f.read(), context)
-            try:
-                exec(f.read(), context)
-            except Exception as e:
-                msg = 'There is a syntax error in {}\n{}'.format(filename, e)
-                raise SyntaxError(msg)
+            text = f.read()
+        try:
+            code = compile(text, filename, 'exec')
+        except SyntaxError as e:
+            msg = 'There is a syntax error in {}\n{}'.format(filename, e)
+            raise SyntaxError(msg)
+        exec(code, context)
 
     else:
         msg = 'Config file does not exist: {}'.format(filename)
@@ -83,12 +173,13 @@ def register_include(path):
         dirpath = os.path.dirname(os.path.realpath(__file__))
         path = os.path.join(dirpath, 'plugins')
 
-    abspath = os.path.abspath(path)
+    # paths are relative to the including smbuild file
+    abspath = os.path.abspath(os.path.join(os.path.join(*DirectoryStack), path))
     if abspath not in IncludedPaths:
+        IncludedPaths.add(abspath)
         DirectoryStack.append(path)
         execute_config(os.path.join(*DirectoryStack))
         DirectoryStack.pop()
-        IncludedPaths.add(abspath)
 
 
 def register_plugin(name=None, source=None, deps=None, binary=None):
@@ -191,6 +282,7 @@ def glob_files(file_list, name, warn_on_empty=False):
     current_path = os.path.join(*DirectoryStack)
     for pattern in file_list:
         matches = glob.glob(os.path.join(current_path, pattern))
+        record_glob(os.path.join(current_path, pattern))
         if matches:
             for f in matches:
                 output.append(f)
@@ -200,6 +292,22 @@ def glob_files(file_list, name, warn_on_empty=False):
     return output
 
 
+def record_glob(pattern):
+    """
+    Adds the directories a glob pattern lists to GlobbedDirs, so callers
+    can tell when the configs would glob something different.
+    """
+    dirname = os.path.dirname(pattern)
+    while glob.has_magic(dirname):
+        dirname = os.path.dirname(dirname)
+    GlobbedDirs.add(os.path.abspath(dirname))
+    for match in glob.glob(os.path.dirname(pattern)):
+        GlobbedDirs.add(os.path.abspath(match))
+
+
 def check_package_cycles(Packages):
-    # TODO: this should cause a util.error is a package cycle is detected
-    pass
+    """
+    Raises a ValueError, with the full path of the cycle, if packages
+    extend each other in a cycle (or extend a package that doesn't exist).
+    """
+    packagegraph.PackageGraph(Packages)
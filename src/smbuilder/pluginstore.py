@@ -0,0 +1,94 @@
+import util
+
+import os
+
+
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+
+class PluginStore:
+    """
+    Content-addressed store of compiled plugins, shared between checkouts.
+    Entries are keyed by the compile key of a plugin (see compilecache), so a
+    hit is an exact match for the source, includes, flags and compiler.
+    Entries are only ever created by renaming complete files into place, so
+    any number of builds may read and write the store at once.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+    def contains(self, key):
+        """Returns whether the store has a plugin stored under key."""
+        return os.path.exists(self._entry_paths(key)[0])
+
+    def fetch(self, key, dest):
+        """
+        Places the plugin stored under key at dest, hard linking it when
+        possible. Returns the compiler warnings recorded for it, or None
+        if the store doesn't have it.
+        """
+        binary, warnings_file = self._entry_paths(key)
+        if not os.path.exists(binary):
+            return None
+
+        try:
+            util.place_file(binary, dest, 'hardlink')
+            # mark it as recently used, for eviction
+            os.utime(binary, None)
+        except (IOError, OSError):
+            return None
+
+        try:
+            with open(warnings_file) as f:
+                return f.read()
+        except (IOError, OSError):
+            return ''
+
+    def put(self, key, binary, warnings):
+        """Adds a compiled plugin to the store."""
+        binary_path, warnings_path = self._entry_paths(key)
+        util.mkdir(os.path.dirname(binary_path))
+        util.write_file_atomic(warnings_path, (warnings or '').encode('utf-8'))
+        util.place_file(binary, binary_path)
+
+    def evict(self):
+        """Removes the least recently used entries until the store fits in max_size."""
+        if not self.max_size or not os.path.isdir(self.path):
+            return
+
+        entries = []
+        total_size = 0
+        for root, dirs, files in os.walk(self.path):
+            for f in files:
+                if not f.endswith('.smx'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(root, f))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, os.path.join(root, f)))
+                total_size += st.st_size
+
+        for mtime, size, binary in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            for path in [binary, os.path.splitext(binary)[0] + '.txt']:
+                try:
+                    os.remove(path)
+                except OSError:
+                    # another build got to it first
+                    pass
+            total_size -= size
+
+    def _entry_paths(self, key):
+        entry = os.path.join(self.path, key[:2], key)
+        return entry + '.smx', entry + '.txt'
+
+
+def parse_size(text):
+    """Parses a size such as '500M' or '2G' into a number of bytes."""
+    text = str(text).strip().upper().rstrip('B')
+    if text and text[-1] in SIZE_SUFFIXES:
+        return int(float(text[:-1]) * SIZE_SUFFIXES[text[-1]])
+    return int(text)
@@ -0,0 +1,125 @@
+import util
+
+import collections
+import json
+import os
+import threading
+import time
+
+
+# the Profiler recording spans, or None when profiling is off
+_profiler = None
+
+
+class Profiler:
+    """
+    Records timed spans of a build, from any thread, as Chrome trace events
+    (viewable in chrome://tracing or https://ui.perfetto.dev).
+    """
+    def __init__(self):
+        self.start = time.time()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def record(self, name, category, start, end, args):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int((start - self.start) * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': os.getpid(),
+            'tid': threading.current_thread().ident,
+            'args': args,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def trace(self):
+        """Returns the recorded spans in the Chrome trace-event JSON format."""
+        with self.lock:
+            return {'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}
+
+    def summary(self, top=10):
+        """
+        Returns a plain-text summary: the total time, count and counters of
+        each kind of span, then the top slowest individual spans.
+        """
+        with self.lock:
+            events = list(self.events)
+
+        totals = collections.OrderedDict()
+        for event in sorted(events, key=lambda e: e['ts']):
+            total = totals.setdefault(event['name'], {'dur': 0, 'count': 0, 'counters': {}})
+            total['dur'] += event['dur']
+            total['count'] += 1
+            for key, value in event['args'].items():
+                if isinstance(value, int) and not isinstance(value, bool):
+                    total['counters'][key] = total['counters'].get(key, 0) + value
+
+        lines = ['Time by phase:']
+        for name, total in sorted(totals.items(), key=lambda item: -item[1]['dur']):
+            counters = ''.join(', {} {}'.format(value, key) for key, value in sorted(total['counters'].items()))
+            lines.append('  {:>9.3f}s  {} ({} calls{})'.format(
+                total['dur'] / 1e6, name, total['count'], counters))
+
+        lines.append('Slowest spans:')
+        for event in sorted(events, key=lambda e: -e['dur'])[:top]:
+            detail = ', '.join('{}={}'.format(k, v) for k, v in sorted(event['args'].items()))
+            lines.append('  {:>9.3f}s  {} {}'.format(event['dur'] / 1e6, event['name'], detail))
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """Writes the Chrome trace-event JSON to a file."""
+        data = json.dumps(self.trace(), separators=(',', ':'))
+        util.write_file_atomic(path, data.encode('utf-8'))
+
+
+class Span:
+    """
+    Context manager timing a block of code. Counters (file counts, byte
+    counts, ...) can be added to args while it runs, and are recorded with it.
+    """
+    def __init__(self, profiler, name, category, args):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.profiler:
+            self.profiler.record(self.name, self.category, self.start, time.time(), self.args)
+        return False
+
+
+def span(name, category, **args):
+    """Returns a Span timing a block of code, which records nothing unless profiling is enabled."""
+    return Span(_profiler, name, category, args)
+
+
+def enable():
+    """Starts recording spans, returning the Profiler they are recorded into."""
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def disable():
+    """Stops recording spans, returning the Profiler they were recorded into (if any)."""
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    return profiler
+
+
+def finish(path):
+    """Stops recording spans, writes them to a trace file, and prints a summary."""
+    profiler = disable()
+    if profiler:
+        profiler.save(path)
+        print(profiler.summary())
+        print('Profile written to {}'.format(path))
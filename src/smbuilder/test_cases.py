@@ -1,10 +1,32 @@
+import archive
 import base
+import buildhistory
 import builder
+import buildserver
+import compilecache
+import compiledriver
+import deploy
+import filecache
+import includescanner
+import packagegraph
+import packagemanifest
+import pluginstore
+import profiler
 import parser
 import structbuilder
+import util
+import watcher
 
+import json
 import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
 import unittest
+import zipfile
 
 
 def test_package():
@@ -13,6 +35,25 @@ def test_package():
     return target
 
 
+FAKE_COMPILER = """#!{}
+import sys
+args = dict(a.split('=', 1) for a in sys.argv[2:] if '=' in a)
+with open(args['-o'] + '.smx', 'w') as f:
+    f.write(open(sys.argv[1]).read())
+print('SourcePawn Compiler')
+print(sys.argv[1] + '(1) : warning 203: symbol is never used: "x"')
+"""
+
+
+def fake_compiler(dirpath):
+    """Writes a stand-in compiler script that copies the source to the output."""
+    path = os.path.join(dirpath, 'fakecomp')
+    with open(path, 'w') as f:
+        f.write(FAKE_COMPILER.format(sys.executable))
+    os.chmod(path, 0o755)
+    return path
+
+
 class BuilderTests(unittest.TestCase):
     def test_find_plugin_deps(self):
         def fake_package(name, plugins):
@@ -31,6 +72,732 @@ class BuilderTests(unittest.TestCase):
         self.assertEqual(expected, base.find_plugin_deps(p1, packages))
 
 
+    def test_compile_plugins_keep_going(self):
+        class FakePlugin:
+            def __init__(self, name, fails):
+                self.name = name
+                self.fails = fails
+                self.attempted = False
+
+            def compile(self, compiler, output_dir, flags, log=None, manifest=None, include_graph=None,
+                        store=None):
+                self.attempted = True
+                if self.fails:
+                    raise base.CompileError('failed ' + self.name)
+                return True
+
+        fakes = [FakePlugin('a', True), FakePlugin('b', False), FakePlugin('c', False)]
+        with self.assertRaises(SystemExit):
+            builder.compile_plugins(fakes, 'spcomp', '', '', jobs=1, keep_going=True)
+        self.assertTrue(all(p.attempted for p in fakes))
+
+        fakes = [FakePlugin('a', False), FakePlugin('b', False)]
+        self.assertEqual(2, builder.compile_plugins(fakes, 'spcomp', '', '', jobs=2))
+
+    def test_compile_order(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        plugins = []
+        for name, size in [('a', 10), ('b', 1000), ('c', 100)]:
+            source = os.path.join(tmpdir, name + '.sp')
+            with open(source, 'w') as f:
+                f.write('/' * size)
+            plugins.append(base.PluginContainer(name, source, None, '', []))
+
+        def order(history):
+            return [p.name for p in buildhistory.compile_order(plugins, history)]
+
+        # without any history, the largest sources go first
+        history = buildhistory.BuildHistory(os.path.join(tmpdir, buildhistory.HISTORY_NAME))
+        self.assertEqual(['b', 'c', 'a'], order(history))
+
+        # recorded durations win, and scale the estimates from size
+        history.record('a', 2.0)
+        history.record('b', 0.01)
+        self.assertEqual(['a', 'c', 'b'], order(history))
+        history.record('a', 4.0)
+        self.assertEqual(3.0, history.duration('a'))
+
+        history.save()
+        history = buildhistory.BuildHistory(history.path)
+        builder.compile_plugins(plugins[2:], fake_compiler(tmpdir), tmpdir, '', jobs=1, history=history)
+        self.assertEqual(3.0, history.duration('a'))
+        self.assertIsNotNone(history.duration('c'))
+
+    def test_workspace_build(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        compiler = fake_compiler(tmpdir)
+        files = {
+            os.path.join('a', 'smbuild'): "Include('../b')\nPackage(name='pa', plugins=['shared'])\n",
+            os.path.join('b', 'smbuild'): "Plugin(source='shared.sp')\nPackage(name='pb', plugins=['shared'])\n",
+            os.path.join('b', 'shared.sp'): '// shared\n',
+            'workspace': '# both repos\na\nb\n',
+        }
+        for name, text in files.items():
+            util.mkdir(os.path.dirname(os.path.join(tmpdir, name)))
+            with open(os.path.join(tmpdir, name), 'w') as f:
+                f.write(text)
+
+        workspace = os.path.join(tmpdir, 'workspace')
+        self.assertEqual(([os.path.join(tmpdir, 'a'), os.path.join(tmpdir, 'b')], os.path.join(tmpdir, 'builds')),
+                         builder.resolve_targets(workspace))
+        builder.perform_builds(workspace, compiler, jobs=1)
+        self.assertEqual(2, len(parser.ConfigFiles))
+        for package in ['pa', 'pb']:
+            binary = os.path.join(tmpdir, 'builds', package, 'addons', 'sourcemod', 'plugins', 'shared.smx')
+            self.assertTrue(os.path.exists(binary))
+        self.assertEqual([], builder.perform_builds(workspace, compiler, jobs=1, plan=True)['actions'])
+        plan = builder.overlay_plan(workspace, 'pa')
+        self.assertEqual('pa', plan.origins[os.path.join('addons', 'sourcemod', 'plugins', 'shared.smx')])
+
+
+class CompileCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_hash_cache(self):
+        compiler = fake_compiler(self.tmpdir)
+        source = os.path.join(self.tmpdir, 'plugin.sp')
+        with open(source, 'w') as f:
+            f.write('#include "lib"\n')
+        with open(os.path.join(self.tmpdir, 'lib.inc'), 'w') as f:
+            f.write('// lib\n')
+
+        plugin = base.PluginContainer('plugin', source, None, '', [])
+        manifest = compilecache.CompileManifest(os.path.join(self.tmpdir, 'manifest.json'))
+        self.assertTrue(plugin.compile(compiler, self.tmpdir, '', [], manifest))
+        self.assertFalse(plugin.compile(compiler, self.tmpdir, '', [], manifest))
+
+        # warnings are replayed when the compile is skipped
+        log = []
+        manifest.save()
+        manifest = compilecache.CompileManifest(manifest.path)
+        self.assertFalse(plugin.compile(compiler, self.tmpdir, '', log, manifest))
+        self.assertTrue(any('symbol is never used' in line for line in log))
+
+        # changing the flags or an include forces a rebuild
+        self.assertTrue(plugin.compile(compiler, self.tmpdir, '-O2', [], manifest))
+        with open(os.path.join(self.tmpdir, 'lib.inc'), 'w') as f:
+            f.write('// lib changed\n')
+        self.assertTrue(plugin.compile(compiler, self.tmpdir, '-O2', [], manifest))
+
+
+    def test_compiler_identity(self):
+        compiler = fake_compiler(self.tmpdir)
+        identity = compilecache.compiler_identity(compiler)
+        self.assertEqual(identity, compilecache.compiler_identity(compiler))
+
+        # replacing the compiler is noticed without restarting the process
+        with open(compiler, 'a') as f:
+            f.write('# upgraded\n')
+        self.assertNotEqual(identity, compilecache.compiler_identity(compiler))
+        self.assertEqual('no-such-spcomp', compilecache.compiler_identity('no-such-spcomp'))
+
+    def test_diagnostics(self):
+        compiler = fake_compiler(self.tmpdir)
+        source_dir = os.path.join(self.tmpdir, 'with space')
+        os.mkdir(source_dir)
+        source = os.path.join(source_dir, 'plugin.sp')
+        with open(source, 'w') as f:
+            f.write('// plugin\n')
+
+        plugin = base.PluginContainer('plugin', source, None, '', [])
+        manifest = compilecache.CompileManifest(os.path.join(self.tmpdir, 'manifest.json'))
+        log = []
+        self.assertTrue(plugin.compile(compiler, source_dir, '', log, manifest))
+        self.assertIn('SourcePawn Compiler', log)
+        self.assertEqual([(source, 1, 'warning', '203')],
+                         [(d.file, d.line, d.severity, d.code) for d in plugin.diagnostics])
+        manifest.save()
+        manifest = compilecache.CompileManifest(manifest.path)
+        self.assertFalse(plugin.compile(compiler, source_dir, '', [], manifest))
+        self.assertEqual('symbol is never used: "x"', plugin.diagnostics[0].message)
+
+        diagnostic = compiledriver.parse_diagnostic('a.sp(3 -- 5) : fatal error 183: brackets')
+        self.assertEqual(('a.sp', 3, 'fatal error'), (diagnostic.file, diagnostic.line, diagnostic.severity))
+        self.assertIsNone(compiledriver.parse_diagnostic('Code size: 100 bytes'))
+
+        failing = os.path.join(self.tmpdir, 'failcomp')
+        with open(failing, 'w') as f:
+            f.write('#!/bin/sh\necho "$1(2) : error 017: undefined symbol" >&2\nexit 1\n')
+        os.chmod(failing, 0o755)
+        with self.assertRaises(base.CompileError) as cm:
+            plugin.compile(failing, source_dir, '', [], manifest)
+        self.assertIn('error 017', str(cm.exception))
+        self.assertIsNone(manifest.get('plugin'))
+
+    def test_plugin_store(self):
+        compiler = fake_compiler(self.tmpdir)
+        source = os.path.join(self.tmpdir, 'plugin.sp')
+        with open(source, 'w') as f:
+            f.write('// plugin\n')
+
+        store = pluginstore.PluginStore(os.path.join(self.tmpdir, 'store'))
+        checkouts = [os.path.join(self.tmpdir, d) for d in ['out1', 'out2']]
+        for d in checkouts:
+            os.mkdir(d)
+
+        plugin = base.PluginContainer('plugin', source, None, '', [])
+        self.assertTrue(plugin.compile(compiler, checkouts[0], '', [], None, None, store))
+        log = []
+        self.assertFalse(plugin.compile(compiler, checkouts[1], '', log, None, None, store))
+        self.assertTrue(any('symbol is never used' in line for line in log))
+        self.assertTrue(os.path.exists(os.path.join(checkouts[1], 'plugin.smx')))
+
+        store.max_size = 1
+        store.evict()
+        self.assertEqual([], [f for f in os.listdir(store.path) if os.listdir(os.path.join(store.path, f))])
+
+    def test_parse_size(self):
+        self.assertEqual(2 << 30, pluginstore.parse_size('2G'))
+        self.assertEqual(500, pluginstore.parse_size('500'))
+
+
+class FileCacheTests(unittest.TestCase):
+    def test_includes_cached_by_stat(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        source = os.path.join(tmpdir, 'plugin.sp')
+        with open(source, 'w') as f:
+            f.write('#include <sourcemod>\n#tryinclude "lib"\n')
+
+        cache_path = os.path.join(tmpdir, 'cache.json')
+        cache = filecache.FileCache(cache_path)
+        expected = [['<sourcemod>', False], ['"lib"', True]]
+        self.assertEqual(expected, [list(i) for i in cache.includes(source)])
+        cache.save()
+
+        cache = filecache.FileCache(cache_path)
+        self.assertEqual(expected, [list(i) for i in cache.includes(source)])
+        self.assertFalse(cache.dirty)
+
+        with open(source, 'w') as f:
+            f.write('#include <sourcemod>\n')
+        self.assertEqual([['<sourcemod>', False]], [list(i) for i in cache.includes(source)])
+
+
+class IncludeGraphTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def test_diamond(self):
+        a = self.write('a.sp', '#include "b"\n#include "c"\n')
+        self.write('b.inc', '#include "d"\n')
+        self.write('c.inc', '#include "d"\n')
+        self.write('d.inc', '')
+        graph = includescanner.IncludeGraph()
+        expected = set(['a.sp', 'b.inc', 'c.inc', 'd.inc'])
+        self.assertEqual(expected, graph.relative_source_files(a))
+
+    def test_system_includes(self):
+        a = self.write('a.sp', '#include <shared>\n#include <sourcemod>\n')
+        for d in ['shared', 'stock']:
+            os.mkdir(os.path.join(self.tmpdir, d))
+        self.write(os.path.join('shared', 'shared.inc'), '#include <sourcemod>\n')
+        stock = self.write(os.path.join('stock', 'sourcemod.inc'), '')
+
+        include_dirs = [os.path.join(self.tmpdir, d) for d in ['shared', 'stock']]
+        graph = includescanner.IncludeGraph(None, include_dirs, include_dirs[1:])
+        digests = graph.input_digests(a)
+        self.assertEqual(set(['a.sp', '<shared.inc>', '<sourcemod.inc>']), set(digests))
+        self.assertEqual(includescanner.IMMUTABLE_DIGEST, digests['<sourcemod.inc>'])
+        self.assertEqual(set(['a.sp']), graph.relative_source_files(a))
+        self.assertEqual(0, graph.latest[stock])
+
+    def test_invalidate(self):
+        a = self.write('a.sp', '#include "b"\n#tryinclude "c"\n')
+        b = self.write('b.inc', '')
+        x = self.write('x.sp', '')
+        graph = includescanner.IncludeGraph()
+        graph.scan(a)
+        graph.scan(x)
+        self.assertEqual(set(['a.sp', 'b.inc']), graph.relative_source_files(a))
+
+        self.write('b.inc', '#include "d"\n')
+        d = self.write('d.inc', '')
+        graph.invalidate([b, d])
+        self.assertNotIn(a, graph.closures)
+        self.assertIn(x, graph.closures)
+        self.assertEqual(set(['a.sp', 'b.inc', 'd.inc']), graph.relative_source_files(a))
+
+        c = self.write('c.inc', '')
+        graph.invalidate([c])
+        self.assertEqual(set(['a.sp', 'b.inc', 'c.inc', 'd.inc']), graph.relative_source_files(a))
+
+    def test_cycle(self):
+        a = self.write('a.sp', '#include "b"\n')
+        self.write('b.inc', '#include "a.sp"\n')
+        with self.assertRaises(SystemExit):
+            includescanner.IncludeGraph().scan(a)
+
+
+class PackageTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.output_dir = os.path.join(self.tmpdir, 'builds')
+        self.cfg_dir = os.path.join(self.tmpdir, 'cfg')
+        os.makedirs(os.path.join(self.output_dir, 'plugins'))
+        os.makedirs(self.cfg_dir)
+        binary = os.path.join(self.output_dir, 'plugins', 'a.smx')
+        with open(binary, 'w') as f:
+            f.write('binary')
+        with open(os.path.join(self.cfg_dir, 'server.cfg'), 'w') as f:
+            f.write('hostname {{hostname}}')
+        self.plugins = {'a': base.PluginContainer('a', None, binary, '', [])}
+
+    def package(self, name, plugins, extends=None, args=None, template_files=None):
+        return base.PackageContainer(name, plugins, {}, extends or [], self.cfg_dir, None, None, None,
+                                     None, '', template_files or [], args or {}, [])
+
+    def test_incremental_create(self):
+        package = self.package('p', ['a'], args={'hostname': 'myserver'})
+        packages = {'p': package}
+        package.create(self.output_dir, packagegraph.PackageGraph(packages), self.plugins, False)
+
+        package_dir = os.path.join(self.output_dir, 'p')
+        cfg = os.path.join(package_dir, 'cfg', 'server.cfg')
+        with open(cfg) as f:
+            self.assertEqual('hostname myserver', f.read())
+
+        stale = os.path.join(package_dir, 'cfg', 'old', 'stale.cfg')
+        os.makedirs(os.path.dirname(stale))
+        with open(stale, 'w') as f:
+            f.write('')
+        os.utime(cfg, (1, 1))
+
+        package.create(self.output_dir, packagegraph.PackageGraph(packages), self.plugins, False)
+        self.assertEqual(1, os.path.getmtime(cfg))
+        self.assertFalse(os.path.exists(os.path.dirname(stale)))
+        self.assertTrue(os.path.exists(os.path.join(package_dir, 'addons', 'sourcemod', 'plugins', 'a.smx')))
+
+
+    def test_template_selection(self):
+        with open(os.path.join(self.cfg_dir, 'spawns.txt'), 'w') as f:
+            f.write('{{hostname}}')
+        with open(os.path.join(self.cfg_dir, 'data.cfg.bak'), 'w') as f:
+            f.write('{{hostname}}')
+        with open(os.path.join(self.cfg_dir, 'binary.cfg'), 'wb') as f:
+            f.write(b'{{hostname}}\0')
+
+        def read(path):
+            with open(os.path.join(self.output_dir, 'p', 'cfg', path), 'rb') as f:
+                return f.read()
+
+        package = self.package('p', [], args={'hostname': 'x'})
+        package.create(self.output_dir, packagegraph.PackageGraph({'p': package}), self.plugins, False)
+        self.assertEqual(b'x', read('spawns.txt'))
+        self.assertEqual(b'{{hostname}}', read('data.cfg.bak'))
+        self.assertEqual(b'{{hostname}}\0', read('binary.cfg'))
+
+        package = self.package('p', [], args={'hostname': 'x'}, template_files=['cfg/server.cfg'])
+        package.create(self.output_dir, packagegraph.PackageGraph({'p': package}), self.plugins, False)
+        self.assertEqual(b'{{hostname}}', read('spawns.txt'))
+        self.assertEqual(b'hostname x', read('server.cfg'))
+
+    def test_link_modes(self):
+        package = self.package('p', ['a'])
+        packages = {'p': package}
+        binary = os.path.join(self.output_dir, 'plugins', 'a.smx')
+        packaged = os.path.join(self.output_dir, 'p', 'addons', 'sourcemod', 'plugins', 'a.smx')
+        cfg = os.path.join(self.output_dir, 'p', 'cfg', 'server.cfg')
+
+        package.create(self.output_dir, packagegraph.PackageGraph(packages), self.plugins, False, 'hardlink')
+        self.assertTrue(os.path.samefile(binary, packaged))
+        self.assertFalse(os.path.samefile(os.path.join(self.cfg_dir, 'server.cfg'), cfg))
+
+        for link_mode in ['reflink', 'copy']:
+            os.remove(packaged)
+            package.create(self.output_dir, packagegraph.PackageGraph(packages), self.plugins, False, link_mode)
+            self.assertFalse(os.path.samefile(binary, packaged))
+            with open(packaged) as f:
+                self.assertEqual('binary', f.read())
+
+    def test_archives(self):
+        package = self.package('p', ['a'], args={'hostname': 'archived'})
+        graph = packagegraph.PackageGraph({'p': package})
+        state_dir = os.path.join(self.output_dir, builder.STATE_DIR)
+        old_member_size = archive.GZIP_MEMBER_SIZE
+        archive.GZIP_MEMBER_SIZE = 512
+        self.addCleanup(setattr, archive, 'GZIP_MEMBER_SIZE', old_member_size)
+
+        path = os.path.join(self.output_dir, 'p.tar.gz')
+        package.create(self.output_dir, graph, self.plugins, False, archive_format='tar.gz', state_dir=state_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.output_dir, 'p')))
+        with tarfile.open(path) as tar:
+            self.assertEqual(['addons/sourcemod/plugins/a.smx', 'cfg/server.cfg'], tar.getnames())
+            self.assertEqual(b'hostname archived', tar.extractfile('cfg/server.cfg').read())
+            self.assertEqual(archive.ENTRY_MTIME, tar.getmember('cfg/server.cfg').mtime)
+
+        # unchanged packages aren't rewritten, and rewriting gives the same bytes
+        mtime = os.stat(path).st_mtime_ns
+        package.create(self.output_dir, graph, self.plugins, False, archive_format='tar.gz', state_dir=state_dir)
+        self.assertEqual(mtime, os.stat(path).st_mtime_ns)
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.remove(path)
+        package.create(self.output_dir, graph, self.plugins, False, archive_format='tar.gz')
+        with open(path, 'rb') as f:
+            self.assertEqual(data, f.read())
+
+        package.create(self.output_dir, graph, self.plugins, False, archive_format='zip')
+        with zipfile.ZipFile(os.path.join(self.output_dir, 'p.zip')) as zf:
+            self.assertEqual(['addons/sourcemod/plugins/a.smx', 'cfg/server.cfg'], zf.namelist())
+            self.assertEqual(b'binary', zf.read('addons/sourcemod/plugins/a.smx'))
+
+    def test_manifest_diff(self):
+        package = self.package('p', ['a'], args={'hostname': 'one'})
+        graph = packagegraph.PackageGraph({'p': package})
+        package.create(self.output_dir, graph, self.plugins, False)
+        manifest_file = packagemanifest.manifest_path(self.output_dir, 'p')
+        old_manifest = os.path.join(self.tmpdir, 'deployed.json')
+        shutil.copy(manifest_file, old_manifest)
+        manifest = packagemanifest.load(manifest_file)
+        cfg = os.path.join(self.output_dir, 'p', 'cfg', 'server.cfg')
+        self.assertEqual({'size': 12, 'sha256': util.file_digest(cfg)}, manifest.files['cfg/server.cfg'])
+
+        with open(os.path.join(self.cfg_dir, 'motd.txt'), 'w') as f:
+            f.write('welcome')
+        package = self.package('p', [], args={'hostname': 'two'})
+        package.create(self.output_dir, packagegraph.PackageGraph({'p': package}), self.plugins, False)
+
+        delta = builder.diff_package(old_manifest, self.output_dir)
+        self.assertEqual(['cfg/motd.txt'], delta['added'])
+        self.assertEqual(['cfg/server.cfg'], delta['changed'])
+        self.assertEqual(['addons/sourcemod/plugins/a.smx'], delta['removed'])
+        with tarfile.open(delta['bundle']) as tar:
+            self.assertEqual(['cfg/motd.txt', 'cfg/server.cfg'], tar.getnames())
+        with open(delta['deletions']) as f:
+            self.assertEqual('addons/sourcemod/plugins/a.smx\n', f.read())
+
+        # once rebuilt as an archive, the package directory is stale
+        package.create(self.output_dir, packagegraph.PackageGraph({'p': package}), self.plugins, False,
+                       archive_format='tar.gz')
+        self.assertEqual('tar.gz', packagemanifest.load(manifest_file).archive_format)
+        with self.assertRaises(ValueError):
+            builder.diff_package(old_manifest, self.output_dir)
+
+    def test_deploy(self):
+        dest = os.path.join(self.tmpdir, 'server')
+        os.makedirs(os.path.join(dest, 'cfg'))
+        with open(os.path.join(dest, 'cfg', 'other.cfg'), 'w') as f:
+            f.write('not ours')
+        package = self.package('p', ['a'], args={'hostname': 'one'})
+        package.create(self.output_dir, packagegraph.PackageGraph({'p': package}), self.plugins, False)
+
+        copied, removed = deploy.deploy_package('p', dest, self.output_dir)
+        self.assertIn('cfg/server.cfg', copied)
+        self.assertEqual([], removed)
+        self.assertEqual(([], []), deploy.deploy_package('p', dest, self.output_dir))
+
+        package = self.package('p', [], args={'hostname': 'two'})
+        package.create(self.output_dir, packagegraph.PackageGraph({'p': package}), self.plugins, False)
+        copied, removed = deploy.deploy_package('p', dest, self.output_dir)
+        self.assertEqual(['cfg/server.cfg'], copied)
+        self.assertEqual(['addons/sourcemod/plugins/a.smx'], removed)
+        with open(os.path.join(dest, 'cfg', 'server.cfg')) as f:
+            self.assertEqual('hostname two', f.read())
+        self.assertFalse(os.path.exists(os.path.join(dest, 'addons')))
+        self.assertTrue(os.path.exists(os.path.join(dest, 'cfg', 'other.cfg')))
+
+        # a file edited at the destination is copied again
+        with open(os.path.join(dest, 'cfg', 'server.cfg'), 'w') as f:
+            f.write('edited')
+        self.assertEqual((['cfg/server.cfg'], []), deploy.deploy_package('p', dest, self.output_dir))
+
+        # once rebuilt as an archive, the package directory is stale
+        package.create(self.output_dir, packagegraph.PackageGraph({'p': package}), self.plugins, False,
+                       archive_format='tar.gz')
+        with self.assertRaises(ValueError):
+            deploy.deploy_package('p', dest, self.output_dir)
+
+    def test_create_packages_collects_errors(self):
+        good = self.package('good', ['a'])
+        bad = self.package('bad', ['missing'])
+        broken_cfg = os.path.join(self.tmpdir, 'broken_cfg')
+        os.mkdir(broken_cfg)
+        with open(os.path.join(broken_cfg, 'server.cfg'), 'w') as f:
+            f.write('hostname {{ hostname')
+        broken = base.PackageContainer('broken', [], {}, [], broken_cfg, None, None, None,
+                                       None, '', [], {}, [])
+        packages = {'good': good, 'bad': bad, 'broken': broken}
+        with self.assertRaises(SystemExit):
+            builder.create_packages([broken, bad, good], self.output_dir, packagegraph.PackageGraph(packages),
+                                    self.plugins, False, jobs=2)
+        self.assertTrue(os.path.exists(os.path.join(self.output_dir, 'good', 'cfg', 'server.cfg')))
+
+
+    def test_overlay_plan(self):
+        # d extends b and c, which both extend a
+        a = self.package('a', ['a'], args={'x': 'a', 'y': 'a'})
+        b = self.package('b', [], extends=['a'], args={'x': 'b'})
+        c = self.package('c', [], extends=['a'], args={'y': 'c'})
+        d = self.package('d', [], extends=['b', 'c'])
+        packages = {'a': a, 'b': b, 'c': c, 'd': d}
+        graph = packagegraph.PackageGraph(packages)
+        self.assertEqual(['a', 'b', 'c', 'd'], graph.layers('d'))
+        self.assertEqual(frozenset(['a']), graph.plugin_deps('d'))
+        args = graph.template_args('d', self.plugins)
+        self.assertEqual(('b', 'c', 'd'), (args['x'], args['y'], args['package']))
+        self.assertEqual(['a.smx'], args['plugin_binaries'])
+
+        plan = base.plan_package(d, self.output_dir, graph, self.plugins, False)
+        cfg = os.path.join('cfg', 'server.cfg')
+        self.assertEqual('d', plan.to_dict()['files'][cfg]['from'])
+        self.assertEqual('a', plan.origins[os.path.join('addons', 'sourcemod', 'plugins', 'a.smx')])
+
+    def test_package_cycle(self):
+        a = self.package('a', [], extends=['c'])
+        b = self.package('b', [], extends=['a'])
+        c = self.package('c', [], extends=['b'])
+        with self.assertRaisesRegex(ValueError, 'a -> c -> b -> a'):
+            parser.check_package_cycles({'a': a, 'b': b, 'c': c})
+
+
+class PlanTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.compiler = fake_compiler(self.tmpdir)
+        self.write('smbuild', "Plugin(source='plugin.sp')\nPackage(name='p', plugins=['plugin'])\n")
+        self.write('plugin.sp', '#include "lib"\n')
+        self.write('lib.inc', '// lib\n')
+        self.write(os.path.join('cfg', 'server.cfg'), 'hostname {{package}}\n')
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        util.mkdir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+
+    def plan(self):
+        return builder.perform_builds(self.tmpdir, self.compiler, jobs=1, plan=True)['actions']
+
+    def test_template_cache_scoped_to_build(self):
+        builder.perform_builds(self.tmpdir, self.compiler, jobs=1)
+        self.assertIsNone(base._template_env.bytecode_cache)
+
+        # a build without the cache must not write to the last build's one
+        output_dir = os.path.join(self.tmpdir, 'builds')
+        shutil.rmtree(output_dir)
+        builder.perform_builds(self.tmpdir, self.compiler, jobs=1, template_cache=False)
+        self.assertFalse(os.path.exists(os.path.join(output_dir, builder.STATE_DIR, 'templates')))
+        with open(os.path.join(output_dir, 'p', 'cfg', 'server.cfg')) as f:
+            self.assertEqual('hostname p', f.read())
+
+    def test_plan_archive(self):
+        def plan():
+            return builder.perform_builds(self.tmpdir, self.compiler, jobs=1, plan=True,
+                                          archive_format='tar.gz')['actions']
+
+        self.assertIn('archive:p:cfg/server.cfg', [a['id'] for a in plan()])
+        builder.perform_builds(self.tmpdir, self.compiler, jobs=1, archive_format='tar.gz')
+        self.assertEqual([], plan())
+
+        self.write(os.path.join('cfg', 'server.cfg'), 'hostname {{package}} changed\n')
+        actions = plan()
+        self.assertEqual(['archive:p:cfg/server.cfg'], [a['id'] for a in actions])
+        self.assertEqual(['source changed'], actions[0]['reasons'])
+
+        # the directory plan is unaffected by the archive
+        self.assertIn('render:p:' + os.path.join('cfg', 'server.cfg'), [a['id'] for a in self.plan()])
+
+    def test_plan(self):
+        actions = dict((a['id'], a) for a in self.plan())
+        self.assertEqual(['missing output', 'no previous build'], actions['compile:plugin']['reasons'])
+        binary_copy = actions['copy:p:' + os.path.join('addons', 'sourcemod', 'plugins', 'plugin.smx')]
+        self.assertEqual(['compile:plugin'], binary_copy['depends_on'])
+        self.assertIn('render:p:' + os.path.join('cfg', 'server.cfg'), actions)
+
+        builder.perform_builds(self.tmpdir, self.compiler, jobs=1)
+        self.assertEqual([], self.plan())
+
+        self.write('lib.inc', '// lib changed\n')
+        actions = self.plan()
+        self.assertEqual(['changed include: lib.inc'], actions[0]['reasons'])
+
+        # a deleted binary is recompiled, and copied again once it is
+        builder.perform_builds(self.tmpdir, self.compiler, jobs=1)
+        os.remove(os.path.join(self.tmpdir, 'builds', 'plugins', 'plugin.smx'))
+        actions = dict((a['id'], a) for a in self.plan())
+        self.assertEqual(['missing output'], actions['compile:plugin']['reasons'])
+        self.assertEqual(['compile:plugin'], actions[binary_copy['id']]['depends_on'])
+        self.assertEqual('missing source', util.sync_reason(binary_copy['source'], __file__))
+
+
+class WatchTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.compiler = fake_compiler(self.tmpdir)
+        self.write('smbuild', "Plugin(source='plugin.sp')\nPackage(name='p', plugins=['plugin'])\n")
+        self.write('plugin.sp', '#include "lib"\n')
+        self.write('lib.inc', '// lib\n')
+        self.write(os.path.join('cfg', 'server.cfg'), 'hostname one\n')
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir, name)
+        util.mkdir(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def read(self, name):
+        with open(os.path.join(self.tmpdir, 'builds', name)) as f:
+            return f.read()
+
+    def test_rebuild(self):
+        session = watcher.WatchSession(self.tmpdir, self.compiler, jobs=1)
+        session.load()
+        self.assertIn(self.tmpdir, session.watched_dirs())
+        self.assertNotIn(session.output_dir, session.watched_dirs())
+
+        # mark the binary, so a recompile is noticeable
+        self.write(os.path.join('builds', 'plugins', 'plugin.smx'), 'old')
+        changed = self.write(os.path.join('cfg', 'server.cfg'), 'hostname two\n')
+        self.assertTrue(session.rebuild([changed]))
+        self.assertEqual('hostname two', self.read(os.path.join('p', 'cfg', 'server.cfg')))
+        self.assertEqual('old', self.read(os.path.join('plugins', 'plugin.smx')))
+
+        changed = self.write('lib.inc', '// lib changed\n')
+        self.assertTrue(session.rebuild([changed]))
+        self.assertNotEqual('old', self.read(os.path.join('plugins', 'plugin.smx')))
+
+        self.assertFalse(session.rebuild([self.write('unrelated.txt', '')]))
+
+    def test_rebuild_archive(self):
+        session = watcher.WatchSession(self.tmpdir, self.compiler, jobs=1, archive_format='zip')
+        session.load()
+        self.assertFalse(os.path.exists(os.path.join(session.output_dir, 'p')))
+
+        changed = self.write(os.path.join('cfg', 'server.cfg'), 'hostname two\n')
+        self.assertTrue(session.rebuild([changed]))
+        with zipfile.ZipFile(os.path.join(session.output_dir, 'p.zip')) as zf:
+            self.assertEqual(b'hostname two', zf.read('cfg/server.cfg'))
+
+    def test_rebuild_globbed(self):
+        self.write('smbuild', "GlobPlugins('scripting/*.sp')\nPackage(name='p', plugins=Plugins('*'))\n")
+        self.write(os.path.join('scripting', 'a.sp'), '// a\n')
+        session = watcher.WatchSession(self.tmpdir, self.compiler, jobs=1)
+        session.load()
+        self.assertIn(os.path.join(self.tmpdir, 'scripting'), session.watched_dirs())
+
+        # a new file matching the glob is a new plugin
+        changed = self.write(os.path.join('scripting', 'b.sp'), '// b\n')
+        self.assertTrue(session.rebuild([changed]))
+        self.assertEqual(['a', 'b'], session.plugins_to_compile)
+        self.assertEqual('// b\n', self.read(os.path.join('plugins', 'b.smx')))
+
+    def test_polling_monitor(self):
+        monitor = watcher.PollingMonitor(interval=0.01)
+        monitor.watch([self.tmpdir])
+        self.assertEqual(set(), monitor.wait(timeout=0.05))
+        path = self.write('lib.inc', '// lib changed, and longer\n')
+        self.assertEqual(set([path]), monitor.wait(timeout=1))
+
+
+class DaemonTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.smbuild = os.path.join(self.tmpdir, 'smbuild')
+        with open(self.smbuild, 'w') as f:
+            f.write("GlobPlugins('*.sp')\n")
+        open(os.path.join(self.tmpdir, 'a.sp'), 'w').close()
+
+    def test_warm_configs(self):
+        warm = buildserver.WarmState()
+        plugins, _ = warm.parse_configs(self.tmpdir)
+        self.assertIs(plugins, warm.parse_configs(self.tmpdir)[0])
+
+        # a new file in a globbed directory reloads the configs
+        open(os.path.join(self.tmpdir, 'b.sp'), 'w').close()
+        plugins, _ = warm.parse_configs(self.tmpdir)
+        self.assertEqual(['a', 'b'], sorted(plugins))
+
+    def test_client(self):
+        def handler(argv, warm):
+            print(' '.join(argv))
+            print(os.getcwd())
+            exit(3)
+
+        path = os.path.join(self.tmpdir, 'daemon.sock')
+        server = buildserver.BuildServer(path, handler)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+
+        client = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'scripts', 'smbuilderc')
+        env = dict(os.environ, SMBUILDER_SOCKET=path)
+        proc = subprocess.Popen([sys.executable, client, 'some', '--args'], cwd=self.tmpdir, env=env,
+                                stdout=subprocess.PIPE)
+        out, _ = proc.communicate()
+        thread.join()
+        self.assertEqual(3, proc.returncode)
+        self.assertEqual('some --args\n{}\n'.format(os.path.realpath(self.tmpdir)), out.decode('utf-8'))
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_profile(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        compiler = fake_compiler(tmpdir)
+        with open(os.path.join(tmpdir, 'smbuild'), 'w') as f:
+            f.write("Plugin(source='plugin.sp')\nPackage(name='p', plugins=['plugin'])\n")
+        with open(os.path.join(tmpdir, 'plugin.sp'), 'w') as f:
+            f.write('// plugin\n')
+
+        self.assertIsNone(profiler.span('unused', 'test').profiler)
+        profile = profiler.enable()
+        try:
+            builder.perform_builds(tmpdir, compiler, jobs=1)
+        finally:
+            profiler.disable()
+
+        events = profile.trace()['traceEvents']
+        names = set(e['name'] for e in events)
+        for name in ['parse_configs', 'scan_includes', 'compile', 'spcomp', 'build_package', 'replace_args']:
+            self.assertIn(name, names)
+        copied = [e for e in events if e['name'] == 'build_package'][0]
+        # the binary and its source
+        binary = os.path.join(tmpdir, 'builds', 'plugins', 'plugin.smx')
+        sizes = [os.path.getsize(os.path.join(tmpdir, 'plugin.sp')), os.path.getsize(binary)]
+        self.assertEqual(2, copied['args']['files'])
+        self.assertEqual(sum(sizes), copied['args']['bytes'])
+        self.assertIn('compile (1 calls)', profile.summary())
+
+    def test_profile_flag(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        compiler = fake_compiler(tmpdir)
+        with open(os.path.join(tmpdir, 'smbuild'), 'w') as f:
+            f.write("Plugin(source='plugin.sp')\nPackage(name='p', plugins=['plugin'])\n")
+        with open(os.path.join(tmpdir, 'plugin.sp'), 'w') as f:
+            f.write('// plugin\n')
+
+        # run the script as it's installed, with the package imported as smbuilder
+        src_dir = os.path.dirname(os.path.realpath(__file__))
+        script = os.path.join(src_dir, '..', '..', 'scripts', 'smbuilder')
+        env = dict(os.environ, HOME=tmpdir, XDG_CONFIG_HOME=tmpdir,
+                   PYTHONPATH=os.pathsep.join([os.path.dirname(src_dir), src_dir]))
+        trace = os.path.join(tmpdir, 'profile.json')
+        subprocess.check_call([sys.executable, script, tmpdir, '-c', compiler, '--profile', trace],
+                              env=env, stdout=subprocess.DEVNULL)
+        with open(trace) as f:
+            names = set(e['name'] for e in json.load(f)['traceEvents'])
+        self.assertIn('compile', names)
+        self.assertIn('build_package', names)
+
+
 class ParserTests(unittest.TestCase):
     def test_examples(self):
         target = test_package()
@@ -42,6 +809,42 @@ class ParserTests(unittest.TestCase):
         self.assertEqual(packages, sorted(parser.Packages.keys()))
         self.assertEqual(plugins, sorted(parser.Plugins.keys()))
 
+    def test_registry_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        smbuild = os.path.join(tmpdir, 'smbuild')
+        with open(smbuild, 'w') as f:
+            f.write("GlobPlugins('scripting/*.sp')\nPackage(name='p', plugins=Plugins('*'))\n")
+        util.mkdir(os.path.join(tmpdir, 'scripting'))
+        open(os.path.join(tmpdir, 'scripting', 'a.sp'), 'w').close()
+
+        cache_path = os.path.join(tmpdir, 'builds', parser.REGISTRY_NAME)
+        parser.parse_configs(tmpdir, cache_path)
+        self.assertIsNotNone(parser.load_registry(cache_path, tmpdir))
+        plugins, packages = parser.parse_configs(tmpdir, cache_path)
+        self.assertEqual(['a'], packages['p'].plugins)
+        self.assertEqual([os.path.abspath(smbuild)], parser.ConfigFiles)
+
+        # a new file in a globbed directory invalidates the cache
+        open(os.path.join(tmpdir, 'scripting', 'b.sp'), 'w').close()
+        self.assertIsNone(parser.load_registry(cache_path, tmpdir))
+        plugins, packages = parser.parse_configs(tmpdir, cache_path)
+        self.assertEqual(['a', 'b'], sorted(packages['p'].plugins))
+
+        # as does editing an smbuild file
+        with open(smbuild, 'a') as f:
+            f.write("Package(name='q')\n")
+        self.assertIsNone(parser.load_registry(cache_path, tmpdir))
+        plugins, packages = parser.parse_configs(tmpdir, cache_path)
+        self.assertEqual(['p', 'q'], sorted(packages))
+
+    def test_syntax_error(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        with open(os.path.join(tmpdir, 'smbuild'), 'w') as f:
+            f.write("Package(name='p'\n")
+        self.assertRaises(SyntaxError, parser.parse_configs, tmpdir)
+
 
 class BaseTests(unittest.TestCase):
     def test_templatize(self):
@@ -60,6 +863,19 @@ class BaseTests(unittest.TestCase):
         """
         self.assertEqual(expected, actual)
 
+    def test_template_cache(self):
+        text = 'hostname {{name}}'
+        self.assertIs(base.get_template(text), base.get_template(text))
+        self.assertEqual('hostname a', base.templatize(text, {'name': 'a'}))
+        self.assertEqual('hostname b', base.templatize(text, {'name': 'b'}))
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        base.set_template_cache_dir(tmpdir)
+        self.addCleanup(base.set_template_cache_dir, None)
+        self.assertEqual('x 1', base.templatize('x {{y}}', {'y': 1}))
+        self.assertTrue(os.listdir(tmpdir))
+
 
 class OverallTest(unittest.TestCase):
     def test_overall(self):
@@ -1,32 +1,244 @@
+import filecmp
+import hashlib
+import multiprocessing
 import os
 import shutil
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 GLOBAL_NOCOLOR = False
 
-def warning(text):
-    """Prints a warning message to the console."""
+# mode for files we create through temporary files, which would otherwise be private
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+FILE_MODE = 0o666 & ~_UMASK
+
+# ways package files can be placed, see sync_file
+LINK_MODES = ['copy', 'hardlink', 'reflink']
+
+# linux ioctl that shares a file's extents with another file (copy-on-write)
+FICLONE = 0x40049409
+
+def warning(text, log=None):
+    """
+    Prints a warning message to the console.
+    If a log list is given, the message is appended to it instead.
+    """
     if GLOBAL_NOCOLOR:
-        print('WARNING: ' + text)
+        output('WARNING: ' + text, log)
     else:
-        print(bcolors.WARNING + 'WARNING: ' + bcolors.ENDC + text)
+        output(bcolors.WARNING + 'WARNING: ' + bcolors.ENDC + text, log)
 
 
-def error(text, die=True):
+def error(text, die=True, log=None):
     """Prints an error message to the console and kills the process if wanted."""
     if GLOBAL_NOCOLOR:
-        print('ERROR: ' + text)
+        output('ERROR: ' + text, log)
     else:
-        print(bcolors.FAIL + 'ERROR: ' + bcolors.ENDC + text)
+        output(bcolors.FAIL + 'ERROR: ' + bcolors.ENDC + text, log)
 
     if die:
         exit(1)
 
 
+def output(text, log=None):
+    """Prints a line of text, or appends it to a log list if one is given."""
+    if log is None:
+        print(text)
+    else:
+        log.append(text)
+
+
+def cpu_count():
+    """Returns the number of CPUs available, used as the default job count."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
 def mkdir(*args):
     """Creates a directory path if it doesn't exist."""
-    path = ''.join(os.path.join(args))
-    if not os.path.exists(path):
+    path = os.path.join(*args)
+    try:
         os.makedirs(path)
+    except OSError:
+        # another job may have created it in the meantime
+        if not os.path.isdir(path):
+            raise
+
+
+def file_digest(path):
+    """Returns the sha256 hex digest of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def stat_key(st):
+    """Returns the [size, mtime, inode] of an os.stat result, which identify a version of a file."""
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+def file_stat_key(path):
+    """Returns the stat_key of a file or directory, or None if it doesn't exist."""
+    try:
+        return stat_key(os.stat(path))
+    except OSError:
+        return None
+
+
+def write_file_atomic(path, data):
+    """Writes bytes to a file by renaming a temporary file into place."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                    prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+def write_chunks_if_changed(path, chunks):
+    """
+    Streams chunks of bytes into a file, unless it already has that content.
+    Returns whether the file was written.
+    """
+    mkdir(os.path.dirname(path))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+        if os.path.exists(path) and filecmp.cmp(tmp_path, path, shallow=False):
+            os.remove(tmp_path)
+            return False
+
+        os.chmod(tmp_path, FILE_MODE)
+        os.replace(tmp_path, path)
+        return True
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def sync_file(src, dst, link_mode='copy'):
+    """
+    Places a file at a destination, unless the destination already matches it.
+    A destination with the same size and modification time (as left by a
+    previous sync) is assumed to match, otherwise the contents are compared.
+    The link_mode is one of LINK_MODES: with 'hardlink' or 'reflink' the file
+    shares its data with the source instead of being copied, falling back to
+    a copy when that isn't possible (e.g. across filesystems).
+    Returns whether the file was placed.
+    """
+    if not sync_reason(src, dst):
+        return False
+
+    place_file(src, dst, link_mode)
+    return True
+
+
+def place_file(src, dst, link_mode='copy'):
+    """
+    Copies (or links, see sync_file) a file to a destination atomically:
+    it is written next to the destination, then renamed into place.
+    """
+    mkdir(os.path.dirname(dst))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst), prefix='.' + os.path.basename(dst))
+    os.close(fd)
+    try:
+        if not _link_file(src, tmp_path, link_mode):
+            shutil.copy2(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def sync_reason(src, dst):
+    """
+    Returns why dst needs to be replaced with src ('missing output',
+    'missing source' or 'source changed'), or None if it already matches.
+    See sync_file.
+    """
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        return 'missing output'
+
+    try:
+        src_stat = os.stat(src)
+    except OSError:
+        return 'missing source'
+    if os.path.samestat(src_stat, dst_stat):
+        return None
+    if src_stat.st_size == dst_stat.st_size:
+        if src_stat.st_mtime_ns == dst_stat.st_mtime_ns or filecmp.cmp(src, dst, shallow=False):
+            return None
+    return 'source changed'
+
+
+def _link_file(src, dst, link_mode):
+    """Tries to place src at the (existing, empty) dst without copying. Returns whether it did."""
+    try:
+        if link_mode == 'hardlink':
+            os.remove(dst)
+            try:
+                os.link(src, dst)
+            except OSError:
+                # recreate it for the copy to fall back to
+                open(dst, 'wb').close()
+                raise
+            return True
+
+        elif link_mode == 'reflink' and fcntl:
+            with open(src, 'rb') as src_file:
+                with open(dst, 'wb') as dst_file:
+                    fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return True
+
+    except (OSError, IOError):
+        pass
+
+    return False
+
+
+def stale_files(path, keep):
+    """Returns the relative paths of every file under a directory that is not in keep."""
+    keep = set(os.path.normpath(f) for f in keep)
+    stale = []
+    for dirname, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            relative_path = os.path.relpath(os.path.join(dirname, filename), path)
+            if relative_path not in keep:
+                stale.append(relative_path)
+    return stale
+
+
+def remove_stale_files(path, keep):
+    """
+    Removes every file under a directory whose relative path is not in keep,
+    and any directories left empty.
+    """
+    for relative_path in stale_files(path, keep):
+        os.remove(os.path.join(path, relative_path))
+    for dirname, dirnames, filenames in os.walk(path, topdown=False):
+        if dirname != path and not os.listdir(dirname):
+            os.rmdir(dirname)
 
 
 def copytree(src, dst):
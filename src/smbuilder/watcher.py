@@ -0,0 +1,336 @@
+import archive
+import base
+import builder
+import packagegraph
+import parser
+import util
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+
+# how long to keep collecting changes after the first one, so a save that
+# touches several files only triggers one rebuild
+DEBOUNCE_SECONDS = 0.05
+
+# returned in a set of changes when the monitor lost track of what changed
+FULL_REBUILD = '<full rebuild>'
+
+# inotify constants, see <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+IN_EVENT_HEADER = struct.Struct('iIII')
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+
+class InotifyMonitor:
+    """Detects file changes in a set of directories with Linux inotify."""
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def watch(self, directories):
+        """Watches exactly the given directories (not recursively)."""
+        directories = set(directories)
+        for wd, directory in list(self.watches.items()):
+            if directory not in directories:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+        watched = set(self.watches.values())
+        for directory in directories - watched:
+            wd = self.libc.inotify_add_watch(self.fd, directory.encode('utf-8'), WATCH_MASK)
+            if wd >= 0:
+                self.watches[wd] = directory
+
+    def wait(self, timeout=None):
+        """Returns the set of changed paths, or an empty set after timeout seconds."""
+        changed = set()
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        while readable:
+            self._read_events(changed)
+            readable, _, _ = select.select([self.fd], [], [], DEBOUNCE_SECONDS)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+    def _read_events(self, changed):
+        data = os.read(self.fd, 1 << 16)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = IN_EVENT_HEADER.unpack_from(data, offset)
+            offset += IN_EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.add(FULL_REBUILD)
+            elif wd in self.watches:
+                changed.add(os.path.join(self.watches[wd], name))
+
+
+class PollingMonitor:
+    """Detects file changes in a set of directories by comparing stat results."""
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.directories = set()
+        self.snapshot = {}
+
+    def watch(self, directories):
+        """Watches exactly the given directories (not recursively)."""
+        self.directories = set(directories)
+        self.snapshot = self._scan()
+
+    def wait(self, timeout=None):
+        """Returns the set of changed paths, or an empty set after timeout seconds."""
+        start = time.time()
+        while timeout is None or time.time() - start < timeout:
+            time.sleep(self.interval)
+            snapshot = self._scan()
+            changed = set(snapshot) ^ set(self.snapshot)
+            for path in set(snapshot) & set(self.snapshot):
+                if snapshot[path] != self.snapshot[path]:
+                    changed.add(path)
+            self.snapshot = snapshot
+            if changed:
+                return changed
+        return set()
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        snapshot = {}
+        for directory in self.directories:
+            try:
+                names = os.listdir(directory)
+            except OSError:
+                continue
+            for name in names:
+                path = os.path.join(directory, name)
+                stamp = util.file_stat_key(path)
+                if stamp is not None:
+                    snapshot[path] = stamp
+        return snapshot
+
+
+def create_monitor():
+    """Returns an InotifyMonitor if the platform supports it, otherwise a PollingMonitor."""
+    try:
+        return InotifyMonitor()
+    except (OSError, AttributeError, TypeError):
+        return PollingMonitor()
+
+
+class WatchSession:
+    """
+    Keeps a target's parsed configs, include graph and package plans in memory
+    between builds, and rebuilds only what a set of changed files affects:
+    the plugins that (transitively) include them, and the packages that
+    contain those plugins or the changed files. Changing an smbuild file
+    reloads everything.
+    """
+    def __init__(self, target='.', compiler='spcomp', flags='', nosource=False, jobs=None,
+                 include_dirs=None, immutable_stock_includes=False, store=None, link_mode='copy',
+                 template_cache=True, archive_format=None):
+        if archive_format:
+            archive.check_format(archive_format)
+        self.target = target
+        self.compiler = compiler
+        self.flags = flags
+        self.nosource = nosource
+        self.jobs = jobs
+        self.include_dirs = include_dirs
+        self.immutable_stock_includes = immutable_stock_includes
+        self.store = store
+        self.link_mode = link_mode
+        self.template_cache = template_cache
+        self.archive_format = archive_format
+        self.config_files = None
+        self.targets, output_dir = builder.resolve_targets(target)
+        self.output_dir = os.path.abspath(output_dir)
+        self.plugin_build_dir = os.path.join(self.output_dir, 'plugins')
+
+    def load(self):
+        """Parses the configs from scratch, and brings the whole build up to date."""
+        self.config_files = None
+        self.plugins, self.packages = parser.parse_configs(self.targets)
+        self.graph = packagegraph.PackageGraph(self.packages)
+        smbuildfiles = [os.path.join(t, parser.CONFIG_NAME) for t in self.targets]
+        self.packages_to_build, self.plugins_to_compile = builder.select_targets(
+            smbuildfiles, self.plugins, self.packages, self.graph)
+        self.config_files = [os.path.abspath(f) for f in parser.ConfigFiles]
+        self.glob_listings = parser.registry_inputs([], parser.GlobbedDirs)['listings']
+
+        self.manifest = builder.open_manifest(self.output_dir)
+        self.history = builder.open_history(self.output_dir)
+        self.file_cache, self.include_graph = builder.open_include_graph(
+            self.output_dir, self.compiler, self.include_dirs, self.immutable_stock_includes)
+
+        util.mkdir(self.plugin_build_dir)
+        self.plugin_inputs = {}
+        self.package_inputs = {}
+        self._build(self.plugins_to_compile, self.packages_to_build)
+
+    def rebuild(self, changed):
+        """Rebuilds whatever a set of changed paths affects. Returns whether anything was."""
+        if self.config_files is None or FULL_REBUILD in changed:
+            self.load()
+            return True
+
+        changed = set(os.path.abspath(path) for path in changed)
+        changed = set(path for path in changed if not self._is_output(path))
+        if not changed:
+            return False
+
+        if any(os.path.basename(path) == parser.CONFIG_NAME for path in changed) or \
+                self._globs_changed(changed):
+            self.load()
+            return True
+
+        self.include_graph.invalidate(changed)
+
+        # anything without recorded inputs failed last time, so is always retried
+        to_compile = [name for name in self.plugins_to_compile
+                      if name not in self.plugin_inputs or self.plugin_inputs[name] & changed]
+        to_build = []
+        for name in self.packages_to_build:
+            content_dirs = self._content_dirs(name)
+            if name not in self.package_inputs or self.package_inputs[name] & changed or \
+                    any(path.startswith(d + os.sep) for path in changed for d in content_dirs) or \
+                    any(p in to_compile for p in self.graph.plugin_deps(name)):
+                to_build.append(name)
+
+        if not to_compile and not to_build:
+            return False
+
+        self._build(to_compile, to_build)
+        return True
+
+    def watched_dirs(self):
+        """Returns every directory holding an input of the build, leaving out the output."""
+        directories = set(os.path.dirname(f) for f in self.config_files)
+        directories.update(d for d in self.glob_listings if self.glob_listings[d] is not None)
+        for name in self.plugins_to_compile:
+            plugin = self.plugins[name]
+            directories.add(os.path.dirname(os.path.abspath(plugin.source or plugin.binary)))
+            directories.update(os.path.dirname(f) for f in self.plugin_inputs.get(name, []))
+
+        for name in self.packages_to_build:
+            directories.update(os.path.dirname(f) for f in self.package_inputs.get(name, []))
+            for content_dir in self._content_dirs(name):
+                for root, _, _ in os.walk(content_dir):
+                    directories.add(root)
+
+        return set(d for d in directories if not self._is_output(d))
+
+    def _globs_changed(self, changed):
+        """Returns whether files were added to (or removed from) a directory the configs globbed."""
+        dirs = (set(os.path.dirname(path) for path in changed) | changed) & set(self.glob_listings)
+        listings = parser.registry_inputs([], dirs)['listings']
+        return any(listings[d] != self.glob_listings[d] for d in dirs)
+
+    def _is_output(self, path):
+        return path == self.output_dir or path.startswith(self.output_dir + os.sep)
+
+    def _content_dirs(self, name):
+        """Returns the directories whose whole contents end up in a package, across its extends chain."""
+        content_dirs = set()
+        for layer in self.graph.layers(name):
+            package = self.packages[layer]
+            dirs = [package.cfg, package.configs, package.translations, package.data, package.gamedata]
+            for group in package.filegroups.values():
+                dirs.extend(group)
+            content_dirs.update(os.path.abspath(d) for d in dirs if d and os.path.isdir(d))
+        return content_dirs
+
+    def _build(self, plugin_names, package_names):
+        to_compile = [self.plugins[name] for name in plugin_names]
+        for name in plugin_names:
+            self.plugin_inputs.pop(name, None)
+        for name in package_names:
+            self.package_inputs.pop(name, None)
+
+        compiled_count = 0
+        try:
+            for plugin in to_compile:
+                if plugin.source:
+                    self.include_graph.scan(plugin.source)
+            compiled_count = builder.compile_plugins(
+                to_compile, self.compiler, self.plugin_build_dir, self.flags, jobs=self.jobs,
+                manifest=self.manifest, include_graph=self.include_graph, store=self.store,
+                history=self.history)
+        finally:
+            self.manifest.save()
+            self.history.save()
+            self.file_cache.save()
+            if self.store and compiled_count:
+                self.store.evict()
+
+        for plugin in to_compile:
+            if plugin.source:
+                inputs = self.include_graph.source_files(plugin.source) - self.include_graph.immutable
+            else:
+                inputs = set([os.path.abspath(plugin.binary)])
+            self.plugin_inputs[plugin.name] = set(inputs)
+
+        to_build = [self.packages[name] for name in package_names]
+        with builder.template_cache_dir(self.output_dir, self.template_cache):
+            builder.create_packages(to_build, self.output_dir, self.graph, self.plugins, self.nosource,
+                                    self.link_mode, jobs=self.jobs, archive_format=self.archive_format)
+
+        for package in to_build:
+            plan = base.plan_package(package, self.output_dir, self.graph, self.plugins, self.nosource)
+            self.package_inputs[package.name] = set(os.path.abspath(src) for src in plan.files.values())
+
+
+def watch(target='.', compiler='spcomp', flags='', nosource=False, jobs=None,
+          include_dirs=None, immutable_stock_includes=False, store=None, link_mode='copy',
+          template_cache=True, archive_format=None, monitor=None):
+    """
+    Builds a target (see builder.resolve_targets), then rebuilds whatever is
+    affected each time its inputs change, until interrupted. Failed builds
+    are reported, and the next change is waited for.
+    """
+    session = WatchSession(target, compiler, flags, nosource, jobs, include_dirs,
+                           immutable_stock_includes, store, link_mode, template_cache, archive_format)
+    if monitor is None:
+        monitor = create_monitor()
+
+    changed = set([FULL_REBUILD])
+    try:
+        while True:
+            start = time.time()
+            try:
+                if session.rebuild(changed):
+                    print('Rebuilt in {:.2f}s, waiting for changes...'.format(time.time() - start))
+            except SystemExit:
+                util.warning('Build failed, waiting for changes...')
+            except Exception as e:
+                util.error(str(e), die=False)
+                util.warning('Build failed, waiting for changes...')
+
+            if session.config_files is not None:
+                monitor.watch(session.watched_dirs())
+            else:
+                # the configs didn't load, so just wait for them to be fixed
+                config_dirs = [os.path.dirname(os.path.abspath(f)) for f in parser.ConfigFiles]
+                monitor.watch(config_dirs + [os.path.abspath(t) for t in session.targets])
+            changed = monitor.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.close()